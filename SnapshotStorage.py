@@ -1,12 +1,91 @@
 import argparse
-import boto3
-from time import strftime
+from time import strftime, perf_counter
 import configparser
-from botocore.exceptions import ClientError
-import os
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from csv import writer
+from threading import Lock
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import sqlite3
+import sys
+from awsCommon import paginate, run_per_region, get_region_names, setup_logging, close_logging, log_line, \
+    clients, LOG_LEVELS
+from apiMetrics import metrics, instrument, start_profile, report_metrics
+from selectionRules import Rule
+from reportDelivery import share_reports, SES_REGION
+
+EBS_PAGE_SIZE = 10000  # max MaxResults of list_snapshot_blocks
+EBS_BLOCK_SIZE = 524288  # bytes, list_snapshot_blocks always returns 512 KiB blocks
+COMPLETED = Rule('snapshots', states=('completed',))  # the EBS direct APIs can't read pending snapshots
+
+
+class SnapshotCache:
+    """
+    sqlite file that keeps the block count of completed snapshots between runs,
+    completed snapshots never change so each one only has to be counted once
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._db = sqlite3.connect(file_name, check_same_thread=False)  # used by the region threads
+        self._lock = Lock()
+        self._db.execute('CREATE TABLE IF NOT EXISTS snapshot_size (snapshot_id TEXT PRIMARY KEY, region TEXT, '
+                         'blocks INTEGER, block_size INTEGER, scanned_at TEXT)')
+        # blocks changed between a snapshot and the previous snapshot of the same volume (--unique)
+        self._db.execute('CREATE TABLE IF NOT EXISTS snapshot_delta (snapshot_id TEXT, parent_id TEXT, region TEXT, '
+                         'blocks INTEGER, block_size INTEGER, scanned_at TEXT, PRIMARY KEY (snapshot_id, parent_id))')
+
+    def get(self, snapshot_id, parent_id=None):
+        """
+        :param snapshot_id: snapshot to look for
+        :param parent_id: previous snapshot of the volume, to get the changed blocks count instead of the full count
+        :return: cached number of blocks, None if the snapshot was never counted
+        """
+        with self._lock:
+            if parent_id:
+                row = self._db.execute('SELECT blocks FROM snapshot_delta WHERE snapshot_id = ? AND parent_id = ?',
+                                       (snapshot_id, parent_id)).fetchone()
+            else:
+                row = self._db.execute('SELECT blocks FROM snapshot_size WHERE snapshot_id = ?',
+                                       (snapshot_id,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, snapshot_id, region, blocks, parent_id=None):
+        """
+        save the block count of a completed snapshot, or its changed blocks count since parent_id
+        """
+        scanned_at = strftime('%Y-%m-%dT%H:%M:%S')
+        with self._lock:
+            if parent_id:
+                self._db.execute('INSERT OR REPLACE INTO snapshot_delta VALUES (?, ?, ?, ?, ?, ?)',
+                                 (snapshot_id, parent_id, region, blocks, EBS_BLOCK_SIZE, scanned_at))
+            else:
+                self._db.execute('INSERT OR REPLACE INTO snapshot_size VALUES (?, ?, ?, ?, ?)',
+                                 (snapshot_id, region, blocks, EBS_BLOCK_SIZE, scanned_at))
+
+    def evict(self, region, existing_ids):
+        """
+        remove the snapshots of a region that no longer exist
+        :param region: region that was fully scanned
+        :param existing_ids: set of the snapshot ids found by describe_snapshots in the region
+        :return: number of removed snapshots
+        """
+        with self._lock:
+            cached_ids = [row[0] for row in
+                          self._db.execute('SELECT snapshot_id FROM snapshot_size WHERE region = ?', (region,))]
+            removed = [(snapshot_id,) for snapshot_id in cached_ids if snapshot_id not in existing_ids]
+            self._db.executemany('DELETE FROM snapshot_size WHERE snapshot_id = ?', removed)
+
+            delta_ids = self._db.execute('SELECT snapshot_id, parent_id FROM snapshot_delta WHERE region = ?',
+                                         (region,))
+            removed_delta = [ids for ids in delta_ids if ids[0] not in existing_ids or ids[1] not in existing_ids]
+            self._db.executemany('DELETE FROM snapshot_delta WHERE snapshot_id = ? AND parent_id = ?',
+                                 removed_delta)
+        return len(removed)
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
 
 
 def get_config_account():
@@ -22,104 +101,239 @@ def get_config_account():
     return account_details
 
 
-def scan_snapshots(snapshotid):
+def count_snapshot_blocks(ebs, snapshot_id):
+    """
+    count the blocks of a snapshot with the EBS direct API, pages are not kept in memory
+    :param ebs: boto3 ebs client
+    :param snapshot_id: snapshot to count
+    :return: number of blocks (0.5 MB each)
+    """
+    return sum(1 for _ in paginate(ebs, 'list_snapshot_blocks', 'Blocks', page_size=EBS_PAGE_SIZE,
+                                   SnapshotId=snapshot_id))
+
+
+def count_changed_blocks(ebs, first_snapshot_id, second_snapshot_id):
+    """
+    count the blocks written in second_snapshot_id since first_snapshot_id (same volume lineage)
+    blocks that only exist in the first snapshot are not counted
+    :param ebs: boto3 ebs client
+    :return: number of blocks (0.5 MB each)
+    """
+    return sum(1 for _ in paginate(ebs, 'list_changed_blocks', 'ChangedBlocks[?SecondBlockToken]',
+                                   page_size=EBS_PAGE_SIZE, FirstSnapshotId=first_snapshot_id,
+                                   SecondSnapshotId=second_snapshot_id))
+
+
+def scan_snapshots(region, snapshotid=None):
     """
     check the actual size of snapshots
+    :param region: region to scan
     :param snapshotid: if operation=snap contain snap ID else contain None
+    :return: (number of snapshots, number of blocks)
     """
 
+    from botocore.exceptions import ClientError
     account = get_config_account()
     Total_snapshot_storage_MB = 0
-    print(regions)
-    _log(f'INFO: Checking snapshots in {regions}')
+    scanned = 0
+    _log(f'INFO: Checking snapshots in {region}')
 
-    ebs = boto3.client('ebs',args.region)
+    ebs = clients.get('ebs', region)
 
     if not snapshotid:
-        # scan all snapshot in a region
-        ec2 = boto3.client('ec2', region_name=regions.strip())
-        response = ec2.describe_snapshots(OwnerIds=account)
-        for snap in response['Snapshots']:
-            try:
-                blocks = ebs.list_snapshot_blocks(SnapshotId=snap['SnapshotId'])
-                # while NextToken not empty - continue counting
-                snap_storage = len(blocks['Blocks'])
-                while blocks.get('NextToken'):
-                    blocks = ebs.list_snapshot_blocks(SnapshotId=snap['SnapshotId'], NextToken=blocks.get('NextToken'))
-                    snap_storage += len(blocks['Blocks'])
+        # scan all snapshot in a region, counting the blocks of several snapshots in parallel
+        ec2 = clients.get('ec2', region)
+        start = perf_counter()
+        from_cache = 0
+        existing_ids = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for snap in paginate(ec2, 'describe_snapshots', 'Snapshots', OwnerIds=account,
+                                 Filters=COMPLETED.filters()):
+                existing_ids.add(snap['SnapshotId'])
+                snap_storage = cache.get(snap['SnapshotId']) if cache else None
+                if snap_storage is None:
+                    futures[executor.submit(count_snapshot_blocks, ebs, snap['SnapshotId'])] = snap
+                    continue
 
+                from_cache += 1
+                scanned += 1
                 Total_snapshot_storage_MB += snap_storage
                 _log(
                     f"{snap['SnapshotId']} ({snap_storage * 0.5} MB), {snap['VolumeId']}({snap['VolumeSize']} GB) ")
 
-            except ClientError as e:
-                _log(f'ERROR: {e}')
+            for future in as_completed(futures):
+                snap = futures.pop(future)
+                try:
+                    snap_storage = future.result()
+                except ClientError as e:
+                    _log(f'ERROR: {e}')
+                    continue
 
-        _log(f"Total snapshot storage for account{account}: {Total_snapshot_storage_MB * 0.5} MB")
+                if cache and snap['State'] == 'completed':  # pending snapshots can still change
+                    cache.put(snap['SnapshotId'], region, snap_storage)
+                scanned += 1
+                Total_snapshot_storage_MB += snap_storage
+                _log(
+                    f"{snap['SnapshotId']} ({snap_storage * 0.5} MB), {snap['VolumeId']}({snap['VolumeSize']} GB) ")
+
+        if cache:
+            _log(f"INFO: {region}: {from_cache} snapshots from cache, removed {cache.evict(region, existing_ids)} "
+                 f"deleted snapshots from {cache.file_name}")
+        _log(f"Total snapshot storage for account{account} in {region}: {Total_snapshot_storage_MB * 0.5} MB")
+        duration = max(perf_counter() - start, 1e-6)
+        _log(f"INFO: {region}: scanned {scanned} snapshots ({Total_snapshot_storage_MB} blocks) in {duration:.1f}s - "
+             f"{scanned / duration:.2f} snapshots/s, {Total_snapshot_storage_MB / duration:.0f} blocks/s")
 
     else:
-        blocks = ebs.list_snapshot_blocks(SnapshotId=snapshotid)
-        Total_snapshot_storage_MB += len(blocks['Blocks'])
+        snap_storage = cache.get(snapshotid) if cache else None
+        if snap_storage is None:
+            snap_storage = count_snapshot_blocks(ebs, snapshotid)
+        Total_snapshot_storage_MB += snap_storage
+        scanned += 1
         _log(
-            f"{snapshotid} ({len(blocks['Blocks']) * 0.5} MB)")
+            f"{snapshotid} ({snap_storage * 0.5} MB)")
+
+    return scanned, Total_snapshot_storage_MB
 
 
-def upload_report_s3(path, bucketName, filename):
+def scan_snapshots_unique(region):
     """
-    Upload files to S3
-    :param path: path to the file
-    :param bucketName: bucket name to upload to
-    :param filename: the file to upload
+    check the unique storage of the snapshots in the region: snapshots are grouped by volume and ordered
+    by StartTime, the first snapshot of a volume is counted fully and each next one only by the blocks
+    changed since the previous snapshot, so data shared along the lineage is counted once
+    :param region: region to scan
+    :return: (number of snapshots, number of unique blocks)
     """
-    s3 = boto3.resource('s3')
-    try:
-        s3.meta.client.upload_file(path, bucketName, filename)
-    except ClientError as e:
-        print(e)
 
+    from botocore.exceptions import ClientError
+    account = get_config_account()
+    _log(f'INFO: Checking unique snapshot storage in {region}')
 
-def send_report_SES(sender, recipient, ses_region, subject, body, file_path):
-    # based on aws example
-    CHARSET = "utf-8"
-    client = boto3.client('ses', region_name=ses_region)
+    ebs = clients.get('ebs', region)
+    ec2 = clients.get('ec2', region)
+    start = perf_counter()
 
-    msg = MIMEMultipart('mixed')
-    msg['Subject'] = subject
-    msg['From'] = sender
-    msg['To'] = recipient
+    lineages = defaultdict(list)  # volume id -> snapshots of the volume
+    for snap in paginate(ec2, 'describe_snapshots', 'Snapshots', OwnerIds=account, Filters=COMPLETED.filters()):
+        # copied snapshots all have vol-ffffffff, they are not related so each one is its own lineage
+        volume = snap['VolumeId'] if snap['VolumeId'] != 'vol-ffffffff' else snap['SnapshotId']
+        lineages[volume].append(snap)
 
-    msg_body = MIMEMultipart('alternative')
-    textpart = MIMEText(body.encode(CHARSET), 'plain', CHARSET)
-    msg_body.attach(textpart)
+    unique_blocks = {}  # snapshot id -> blocks it adds to the lineage
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for snaps in lineages.values():
+            snaps.sort(key=lambda snap: snap['StartTime'])
+            parent_id = None
+            for snap in snaps:
+                snap_storage = cache.get(snap['SnapshotId'], parent_id) if cache else None
+                if snap_storage is not None:
+                    unique_blocks[snap['SnapshotId']] = snap_storage
+                elif parent_id:
+                    futures[executor.submit(count_changed_blocks, ebs, parent_id, snap['SnapshotId'])] = \
+                        (snap, parent_id)
+                else:
+                    futures[executor.submit(count_snapshot_blocks, ebs, snap['SnapshotId'])] = (snap, parent_id)
+                parent_id = snap['SnapshotId']
 
-    attachment = MIMEApplication(open(file_path, 'rb').read())
-    attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(file_path))
+        for future in as_completed(futures):
+            snap, parent_id = futures.pop(future)
+            try:
+                unique_blocks[snap['SnapshotId']] = future.result()
+            except ClientError as e:
+                _log(f"ERROR: {snap['SnapshotId']}: {e}")
+                continue
+            if cache and snap['State'] == 'completed':
+                cache.put(snap['SnapshotId'], region, unique_blocks[snap['SnapshotId']], parent_id)
+
+    Total_snapshot_storage_MB = 0
+    for volume, snaps in lineages.items():
+        volume_storage = 0
+        for snap in snaps:
+            snap_storage = unique_blocks.get(snap['SnapshotId'])
+            if snap_storage is None:
+                continue
+            volume_storage += snap_storage
+            _log(f"{snap['SnapshotId']} ({snap_storage * 0.5} MB unique), {snap['StartTime']}")
+        if not volume_storage:
+            continue
+        Total_snapshot_storage_MB += volume_storage
+        _log(f"{volume}({snaps[0]['VolumeSize']} GB): {len(snaps)} snapshots, {volume_storage * 0.5} MB unique")
+
+    if cache:
+        cache.evict(region, {snap['SnapshotId'] for snaps in lineages.values() for snap in snaps})
+    _log(f"Total unique snapshot storage for account{account} in {region}: {Total_snapshot_storage_MB * 0.5} MB")
+    _log(f"INFO: {region}: scanned {len(unique_blocks)} snapshots of {len(lineages)} volumes in "
+         f"{perf_counter() - start:.1f}s")
+    return len(unique_blocks), Total_snapshot_storage_MB
+
+
+def get_config_regions():
+    """
+    read the [ec2_region] section of config.txt (same section as cleanResources.py)
+    :return: list of regions to scan
+    """
+    _log('INFO: Checking region config')
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+    aws_regions = get_region_names()
+
+    if config['ec2_region'].getboolean('All'):
+        _log('INFO: Regions from config file are - All regions')
+        return aws_regions
+
+    region_list = [region.strip() for region in config['ec2_region']['regions'].split(",")]
+    bad_region = [region for region in region_list if region not in aws_regions]
+    if bad_region:
+        _log(f"ERROR: Not found - {bad_region}, Please check your configuration")
+    region_list = [region for region in region_list if region in aws_regions]
+    _log(f"INFO: Valid regions from config file are - {region_list}")
+    return region_list
 
-    msg.attach(msg_body)
-    msg.attach(attachment)
 
-    try:
-        response = client.send_raw_email(Source=sender, Destinations=[recipient],
-                                         RawMessage={'Data': msg.as_string(), })
-    except ClientError as e:
-        print(e)
+def write_storage_report(results, report_format):
+    """
+    write the storage of each region and the grand total to a csv or xlsx file
+    :param results: dict of region -> (number of snapshots, number of blocks), from run_per_region
+    :param report_format: 'csv' or 'xlsx'
+    :return: the report file name
+    """
+    headers = ("Region", "Snapshots", "Blocks", "Storage MB")
+    rows = [(region, snapshots, blocks, blocks * 0.5) for region, (snapshots, blocks) in sorted(results.items())]
+    total_snapshots = sum(row[1] for row in rows)
+    total_blocks = sum(row[2] for row in rows)
+    rows.append(("Total", total_snapshots, total_blocks, total_blocks * 0.5))
+
+    file_name = strftime('SnapStorage_report_' + "%Y-%b-%d_%H-%M-%S." + report_format)
+    if report_format == 'xlsx':
+        from openpyxl import Workbook  # slow to import, only for the xlsx report
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Snapshots')
+        ws.append(headers)
+        for row in rows:
+            ws.append(row)
+        wb.save(file_name)
+    else:
+        with open(file_name, "w") as file:
+            csv_writer = writer(file, lineterminator='\n')
+            csv_writer.writerow(headers)
+            csv_writer.writerows(rows)
 
+    _log(f"INFO: Total snapshot storage for {len(results)} regions: {total_blocks * 0.5} MB, report - {file_name}")
+    return file_name
 
-def _log(line):
-    # handle print to log file and console
-    console = True
 
-    if Logfile:
-        with open(log_name, "a") as file:
-            file.write(str(line) + '\n')
-    if console:
-        print(line)
+logger = setup_logging('SnapshotStorage')
+
+
+def _log(line, *args):
+    # handle print to log file and console, see awsCommon.log_line
+    log_line(logger, line, *args)
 
 
 if __name__ == '__main__':
 
-    Logfile = False
-    log_name = strftime('SnapStorage_' + "%Y-%b-%d_%H-%M-%S.log")
 
     # get command from CLI
     parser = argparse.ArgumentParser(description='Run CLI to calculate actual Snapshot size')
@@ -127,6 +341,12 @@ if __name__ == '__main__':
                         help='an operation name, Can be "sr"(scan region) or "snap"(check specific snap)')
     parser.add_argument('--region', '-r', type=str,
                         help='region id')
+    parser.add_argument('--all_regions', metavar='Bool', type=str,
+                        help='with "sr", scan the [ec2_region] regions of config.txt instead of --region')
+    parser.add_argument('--region_workers', type=int, default=4,
+                        help='number of regions to scan at the same time with --all_regions (default 4)')
+    parser.add_argument('--report', type=str, choices=('csv', 'xlsx'),
+                        help='write the storage of each region and the total to a csv or xlsx file')
     parser.add_argument('--snapid', '-s', type=str,
                         help='snapshot id if operation is "snap"')
     parser.add_argument('--log', metavar='Bool', type=str,
@@ -134,37 +354,91 @@ if __name__ == '__main__':
     parser.add_argument('--share', '-sh', type=str,
                         help='will share log file via s3 or email')
     parser.add_argument('--bucket_name', '-b', type=str,
-                        help='Bucket name to upload log to, if --share=s3 selected')
+                        help='Bucket name to upload log to, if --share=s3 selected, with --share=email the files '
+                             'too big to attach are uploaded to it and linked')
     parser.add_argument('--ses_sender', '-sess', type=str,
                         help='email SES details, if --share=email selected')
     parser.add_argument('--ses_recipient', '-sesr', type=str,
                         help='email SES details, if --share=email selected')
+    parser.add_argument('--ses_region', type=str, default=SES_REGION,
+                        help=f'SES region, if --share=email selected (default {SES_REGION})')
+    parser.add_argument('--workers', '-w', type=int, default=8,
+                        help='number of snapshots to count at the same time (default 8)')
+    parser.add_argument('--unique', metavar='Bool', type=str,
+                        help='with "sr", count only the blocks each snapshot adds to its volume lineage')
+    parser.add_argument('--cache', metavar='Bool', type=str, default='True',
+                        help='keep the size of completed snapshots in --cache_file between runs (default True)')
+    parser.add_argument('--cache_file', type=str, default='SnapshotCache.db',
+                        help='sqlite file of the snapshot size cache')
+    parser.add_argument('--log_level', type=str, choices=LOG_LEVELS, default='INFO',
+                        help='DEBUG also logs the raw AWS responses (default INFO)')
+    parser.add_argument('--log_json', metavar='Bool', type=str,
+                        help='write the log file as json lines')
+    parser.add_argument('--metrics', metavar='Bool', type=str,
+                        help='write the AWS calls and phases metrics to a json file (the summary is always logged)')
+    parser.add_argument('--profile', metavar='Bool', type=str,
+                        help='run with cProfile and save the stats to a .prof file')
     args = parser.parse_args()
+    workers = max(1, args.workers)
+    clients.configure(workers)
+
+    log_name = strftime('SnapStorage_' + "%Y-%b-%d_%H-%M-%S" + ('.jsonl' if args.log_json == 'True' else '.log'))
+    logger = setup_logging('SnapshotStorage', log_name if args.log == 'True' else None, level=args.log_level,
+                           json_lines=args.log_json == 'True')
+
+    # the arguments are checked before anything slow (boto3 import, describe_regions)
+    if args.operation not in ('sr', 'snap'):
+        _log(f"ERROR: provided argument is incorrect:\n  operation={args.operation}")
+        sys.exit(1)
+    if args.operation == 'snap' and not args.snapid:
+        _log('ERROR: --snapid is needed with "snap"')
+        sys.exit(1)
+    if args.all_regions != 'True' and not args.region:
+        _log('ERROR: --region or --all_regions True is needed')
+        sys.exit(1)
+    if args.share == 's3' and not args.bucket_name:
+        _log('ERROR: --bucket_name is needed with --share s3')
+        sys.exit(1)
+    if args.share == 'email' and not (args.ses_sender and args.ses_recipient):
+        _log('ERROR: --ses_sender and --ses_recipient are needed with --share email')
+        sys.exit(1)
+
+    instrument()
+    profilers = start_profile() if args.profile == 'True' else None
+
+    # regions from config.txt, or the CLI region if it exists (the region list is cached, see get_region_names)
+    if args.all_regions == 'True':
+        regions = get_config_regions()
+    elif args.region in get_region_names():
+        regions = [args.region]
+    else:
+        _log(f"ERROR: region not found - {args.region}")
+        regions = []
+
+    report_name = None
+    if regions:
+        _log(f"INFO: Scanning regions - {regions}")
+        cache = SnapshotCache(args.cache_file) if args.cache == 'True' else None
+        try:
+            # scan entire regions or specific snap.
+            if args.operation == "sr":
+                scan = scan_snapshots_unique if args.unique == 'True' else scan_snapshots
+                with metrics.phase(scan.__name__):
+                    results = run_per_region(scan, regions, args.region_workers, _log)
+                if args.report:
+                    report_name = write_storage_report(results, args.report)
+            elif args.operation == "snap":
+                with metrics.phase('scan_snapshots'):
+                    scan_snapshots(regions[0], args.snapid)
+        finally:
+            if cache:
+                cache.close()
+
+    report_metrics(_log, strftime('SnapStorage_metrics_%Y-%b-%d_%H-%M-%S.json') if args.metrics == 'True' else None,
+                   profilers, strftime('SnapStorage_profile_%Y-%b-%d_%H-%M-%S.prof'))
 
-    if (args.log == 'True'):
-        Logfile = True
-
-    # get region from AWS
-    ebs = boto3.client('ec2','us-east-1')
-    regions = ebs.describe_regions()
-    regions = [region.get('RegionName') for region in regions['Regions']]
-
-    # check region in CLI param exist
-    if args.region in regions:
-        regions = args.region
-        print(regions)
-        # scan entire region or specific snap.
-        if args.operation == "sr":
-            scan_snapshots(None)
-        elif args.operation == "snap":
-            scan_snapshots(args.snapid)
-
-    # share log with email or S3 if requested in CLI
-    bucketName = args.bucket_name
-    path = os.path.abspath(log_name)
-    print(path)
-    if args.log == 'True' and args.share == 's3':
-        upload_report_s3(path, bucketName, log_name)
-    elif args.log == 'True' and args.share == 'email':
-        send_report_SES(args.ses_sender, args.ses_recipient, 'us-east-1', "Storage report",
-                        "Attached storage report log", path)
+    close_logging(logger)  # write the buffered log lines before the log is shared
+    # share log and report with email or S3 if requested in CLI, compressed (links to S3 when too big to email)
+    logger = setup_logging('SnapshotStorage', level=args.log_level)  # the log file is closed, console only
+    share_reports([log_name if args.log == 'True' else None, report_name], args.share, _log, args.bucket_name,
+                  args.ses_sender, args.ses_recipient, "Storage report", "Attached storage report", args.ses_region)
@@ -0,0 +1,177 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+import io
+import json
+import sys
+import threading
+from awsCommon import THROTTLE_CODES
+
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # ms, upper bounds of the histogram
+PROFILE_LINES = 25  # functions of the cProfile stats printed to the log
+
+
+class ApiMetrics:
+    """
+    counts, latency histogram, retries, throttles and response bytes of the AWS calls per region and
+    operation, filled by botocore event hooks (see instrument), plus the wall clock time of the phases
+    """
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.calls = {}  # (region, service, operation) -> counters, see _record
+        self.phases = defaultdict(lambda: {'runs': 0, 'seconds': 0.0})
+        self._lock = Lock()
+
+    def _before_call(self, context, **kwargs):
+        context['metrics_start'] = perf_counter()
+
+    def _after_call(self, event_name, http_response, parsed, model, context, **kwargs):
+        # the content of streaming responses (s3 get_object) is not read here, it belongs to the caller
+        size = 0 if model.has_streaming_output else len(http_response.content or b'')
+        self._record(event_name, context, parsed.get('Error', {}).get('Code'),
+                     parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0), size)
+
+    def _after_call_error(self, event_name, exception, context, **kwargs):
+        self._record(event_name, context, type(exception).__name__, context.get('retries', {}).get('attempt', 1) - 1,
+                     0)
+
+    def _record(self, event_name, context, error, retries, size):
+        seconds = perf_counter() - context.get('metrics_start', perf_counter())
+        _, service, operation = event_name.split('.', 2)
+        bucket = next((i for i, limit in enumerate(LATENCY_BUCKETS) if seconds * 1000 <= limit), len(LATENCY_BUCKETS))
+        with self._lock:
+            key = (context.get('client_region') or 'global', service, operation)
+            if key not in self.calls:
+                self.calls[key] = {'calls': 0, 'errors': 0, 'throttles': 0, 'retries': 0, 'bytes': 0,
+                                   'seconds': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats = self.calls[key]
+            stats['calls'] += 1
+            stats['errors'] += error is not None
+            stats['throttles'] += error in THROTTLE_CODES
+            stats['retries'] += retries
+            stats['bytes'] += size
+            stats['seconds'] += seconds
+            stats['histogram'][bucket] += 1
+
+    @contextmanager
+    def phase(self, name):
+        """
+        time a phase of the run, e.g. with metrics.phase('scan_sg'). a phase running in several
+        region threads at once adds the time of each thread
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name]['runs'] += 1
+                self.phases[name]['seconds'] += perf_counter() - start
+
+    @staticmethod
+    def _percentile(histogram, percent):
+        """
+        :return: upper bound of the histogram bucket of the percentile, e.g. '<=250ms'
+        """
+        needed = sum(histogram) * percent / 100
+        count = 0
+        for i, bucket_count in enumerate(histogram):
+            count += bucket_count
+            if count >= needed:
+                return f'<={LATENCY_BUCKETS[i]}ms' if i < len(LATENCY_BUCKETS) else f'>{LATENCY_BUCKETS[-1]}ms'
+        return 'N/A'
+
+    def summary(self):
+        """
+        :return: text lines of the API calls table (slowest operations first) and of the phases
+        """
+        lines = [f"{'Region':<16}{'Operation':<40}{'Calls':>7}{'Errors':>7}{'Throttles':>10}{'Retries':>8}"
+                 f"{'Avg ms':>8}{'p95':>10}{'KB':>9}"]
+        with self._lock:
+            for (region, service, operation), stats in sorted(self.calls.items(), key=lambda item: -item[1]['seconds']):
+                lines.append(f"{region:<16}{service + '.' + operation:<40}{stats['calls']:>7}{stats['errors']:>7}"
+                             f"{stats['throttles']:>10}{stats['retries']:>8}"
+                             f"{stats['seconds'] * 1000 / stats['calls']:>8.0f}"
+                             f"{self._percentile(stats['histogram'], 95):>10}{stats['bytes'] / 1024:>9.0f}")
+            for name, phase in self.phases.items():
+                lines.append(f"phase {name}: {phase['runs']} runs, {phase['seconds']:.2f}s")
+        lines.append(f"total: {perf_counter() - self.started:.2f}s")
+        return lines
+
+    def to_dict(self):
+        with self._lock:
+            return {'seconds': perf_counter() - self.started,
+                    'latency_buckets_ms': LATENCY_BUCKETS,
+                    'calls': [dict(stats, region=region, service=service, operation=operation)
+                              for (region, service, operation), stats in self.calls.items()],
+                    'phases': dict(self.phases)}
+
+    def write_json(self, file_name):
+        with open(file_name, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+
+metrics = ApiMetrics()  # metrics of the run, filled once instrument() was called
+
+
+def instrument(session=None):
+    """
+    register the metrics hooks in the boto3 session, the clients created after this call are measured
+    :param session: boto3 session, the default session when None
+    """
+    import boto3
+    if session is None:
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        session = boto3.DEFAULT_SESSION
+    session.events.register('before-call', metrics._before_call, unique_id='apiMetrics-before')
+    session.events.register('after-call', metrics._after_call, unique_id='apiMetrics-after')
+    session.events.register('after-call-error', metrics._after_call_error, unique_id='apiMetrics-error')
+
+
+def start_profile():
+    """
+    start cProfile for the main thread and the threads started after this call
+    :return: profilers to pass to report_metrics
+    """
+    import cProfile
+    profilers = [cProfile.Profile()]
+    if sys.version_info < (3, 12):  # older cProfile only profiles the thread that enabled it
+
+        def thread_profile(*args):
+            sys.setprofile(None)
+            profiler = cProfile.Profile()
+            profilers.append(profiler)
+            profiler.enable()
+
+        threading.setprofile(thread_profile)
+    profilers[0].enable()
+    return profilers
+
+
+def report_metrics(log, json_file=None, profilers=None, profile_file=None):
+    """
+    log the metrics summary at the end of a run, write the json file and the profile stats if requested
+    :param log: log function of the calling script
+    :param json_file: file to write the metrics to, None for no file
+    :param profilers: start_profile result, None when the run was not profiled
+    :param profile_file: file for the cProfile stats (pstats format)
+    """
+    for line in metrics.summary():
+        log(f"INFO: {line}")
+    if json_file:
+        metrics.write_json(json_file)
+        log(f"INFO: API metrics saved - {json_file}")
+    if profilers:
+        import pstats
+        threading.setprofile(None)
+        profilers[0].disable()
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(profile_file)
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        log(f"INFO: profile saved - {profile_file}, top functions:\n{output.getvalue()}")
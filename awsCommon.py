@@ -0,0 +1,368 @@
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import MemoryHandler
+from threading import Lock
+from time import perf_counter, sleep, time
+import json
+import logging
+import os
+import random
+import sys
+
+PAGE_SIZE = 1000  # default MaxResults for the describe_* calls, AWS max for most of them
+REGIONS_CACHE = 'RegionsCache.json'
+REGIONS_TTL = 24 * 60 * 60  # seconds, regions are rarely enabled/disabled
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_BUFFER = 1000  # log records kept in memory before they are written to the log file
+API_RATE = 5  # calls per second per region and API action, EC2 refills its mutating actions bucket at 5/s
+API_RETRIES = 8  # retries of a throttled call before the error is returned
+CLIENT_POOL = 10  # HTTP connections of each client, botocore default, set to the worker count by the scripts
+CLIENT_RETRIES = 10  # attempts of a call in the adaptive retry mode of the clients
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'TooManyRequestsException',
+                  'RequestThrottled', 'SlowDown')
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    one json object per log record, for log files read by other tools
+    """
+
+    def format(self, record):
+        return json.dumps({'time': self.formatTime(record), 'level': record.levelname,
+                           'thread': record.threadName, 'message': record.getMessage()}, default=str)
+
+
+class BufferedLogHandler(MemoryHandler):
+    """
+    MemoryHandler that formats the message when the record is logged, the objects passed
+    as args can change before the buffer is written to the file
+    """
+
+    def emit(self, record):
+        record.msg, record.args = record.getMessage(), None
+        super().emit(record)
+
+
+def setup_logging(name, log_file=None, console=True, level='INFO', json_lines=False):
+    """
+    configure the logger of a script. the log file is opened once and records are buffered in memory
+    and written in batches (right away for ERROR). records below level are skipped before their
+    message is formatted, the logged ones are formatted when they are buffered
+    :param name: logger name, the script name
+    :param log_file: file to log to, None for no log file
+    :param console: print the log lines to the console too
+    :param level: one of LOG_LEVELS, DEBUG also logs the raw API responses
+    :param json_lines: write the log file as json lines instead of text
+    :return: the logger
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(console_handler)
+    if log_file:
+        file_handler = logging.FileHandler(log_file, delay=True)
+        file_handler.setFormatter(JsonLinesFormatter() if json_lines else logging.Formatter('%(message)s'))
+        logger.addHandler(BufferedLogHandler(LOG_BUFFER, flushLevel=logging.ERROR, target=file_handler))
+    if not logger.handlers:  # nothing to log to, don't let logging print the warnings to stderr
+        logger.addHandler(logging.NullHandler())
+    return logger
+
+
+def close_logging(logger):
+    """
+    write the buffered records and close the log file, e.g. before the log is uploaded
+    """
+    for handler in list(logger.handlers):
+        handler.flush()
+        if isinstance(handler, MemoryHandler):
+            handler.target.close()
+        handler.close()
+        logger.removeHandler(handler)
+
+
+def log_line(logger, line, *args):
+    """
+    log a line in the scripts format, the level is taken from the 'LEVEL: ' prefix of the line
+    (INFO when there is none). args are %-formatted into the line only if the level is enabled,
+    so big objects (API responses) should be passed as args and not inside an f-string
+    :param logger: logger from setup_logging
+    :param line: line to log, e.g. 'DEBUG: describe_snapshots response %s'
+    """
+    level = str(line).partition(': ')[0]
+    logger.log(getattr(logging, level) if level in LOG_LEVELS else logging.INFO, line, *args)
+
+
+def run_per_region(func, regions, workers, log, *args):
+    """
+    run func(region, *args) for every region in a thread pool.
+    an exception in one region is logged and does not stop the other regions
+    :param func: function that handle a single region, region name is the first argument
+    :param regions: list of region names (from the config file)
+    :param workers: max number of regions to run at the same time
+    :param log: log function of the calling script
+    :param args: extra arguments passed to func after the region
+    :return: dict of region -> func return value, failed regions are not in the dict
+    """
+
+    def _run(region):
+        start = perf_counter()
+        try:
+            return func(region, *args)
+        except Exception as e:  # keep the other regions running
+            log(f"ERROR: region {region} failed in {func.__name__}: {e!r}")
+            raise
+        finally:
+            log(f"INFO: region {region}: {func.__name__} took {perf_counter() - start:.2f}s")
+
+    regions = [region.strip() for region in regions]
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {region: executor.submit(_run, region) for region in regions}
+        for region, future in futures.items():
+            if future.exception() is None:
+                results[region] = future.result()
+    return results
+
+
+def paginate(client, operation, path, page_size=PAGE_SIZE, **kwargs):
+    """
+    generator over all the items of a boto3 list/describe call, one page is fetched at a time
+    so processing starts on the first page and memory does not grow with the number of resources.
+    uses the boto3 paginator when the operation has one, else follows NextToken (ebs calls)
+    :param client: boto3 client
+    :param operation: client method name, e.g. 'describe_volumes'
+    :param path: JMESPath to the items in each page, e.g. 'Volumes' or 'Reservations[].Instances[]'
+    :param page_size: MaxResults for each call
+    :param kwargs: parameters of the call, e.g. OwnerIds
+    """
+    if client.can_paginate(operation):
+        pages = client.get_paginator(operation).paginate(PaginationConfig={'PageSize': page_size}, **kwargs)
+        yield from pages.search(path)
+        return
+
+    import jmespath
+    kwargs['MaxResults'] = page_size
+    while True:
+        response = getattr(client, operation)(**kwargs)
+        yield from jmespath.search(path, response) or []
+        if not response.get('NextToken'):
+            return
+        kwargs['NextToken'] = response['NextToken']
+
+
+def get_sg_attachments(ec2, instance_groups=None):
+    """
+    build the security group -> attachments relation of a region with one paginated pass over the
+    instances and one over the network interfaces, instead of a describe_instances call per SG.
+    interfaces that belong to an instance are reported with the instance id, other interfaces
+    (Lambda, RDS, ELB...) with their own eni id, as the SG is in use by them too
+    :param ec2: boto3 ec2 client of the region
+    :param instance_groups: (instance id, list of sg ids) pairs when the instances were already
+                            fetched (see awsInventory), None to call describe_instances
+    :return: dict of sg id -> list of instance/eni ids using it
+    """
+    attachments = defaultdict(dict)  # dict of dicts, keeps the order and removes duplicates
+
+    if instance_groups is None:
+        instance_groups = ((instance['InstanceId'], [sg['GroupId'] for sg in instance.get('SecurityGroups', [])])
+                           for instance in paginate(ec2, 'describe_instances', 'Reservations[].Instances[]'))
+    for instance_id, group_ids in instance_groups:
+        for group_id in group_ids:
+            attachments[group_id][instance_id] = None
+
+    for eni in paginate(ec2, 'describe_network_interfaces', 'NetworkInterfaces'):
+        used_by = eni.get('Attachment', {}).get('InstanceId') or eni['NetworkInterfaceId']
+        for sg in eni.get('Groups', []):
+            attachments[sg['GroupId']][used_by] = None
+
+    return {group_id: list(used_by) for group_id, used_by in attachments.items()}
+
+
+def get_region_names(cache_file=REGIONS_CACHE, ttl=REGIONS_TTL):
+    """
+    list of the regions enabled for the account. describe_regions is only called when the
+    list saved in cache_file is older than ttl seconds
+    :param cache_file: json file with the region names
+    :param ttl: max age of cache_file in seconds
+    :return: list of region names
+    """
+    try:
+        if time() - os.path.getmtime(cache_file) < ttl:
+            with open(cache_file) as file:
+                return json.load(file)
+    except (OSError, ValueError):  # no cache yet or broken file
+        pass
+
+    response = clients.get('ec2', 'us-east-1').describe_regions()
+    regions = [region['RegionName'] for region in response['Regions']]
+    with open(cache_file, 'w') as file:
+        json.dump(regions, file)
+    return regions
+
+
+class TokenBucket:
+    """
+    token bucket rate limiter, take() blocks until a token is available.
+    the rate can be lowered while the API throttles and goes back up on success
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: tokens added per second
+        :param burst: max tokens in the bucket, rate when None
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self._tokens = self.burst
+        self._last = perf_counter()
+        self._lock = Lock()
+
+    def take(self):
+        with self._lock:
+            now = perf_counter()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:  # the token is reserved, sleep until it is refilled
+            sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.max_rate / 10, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class ApiLimiter:
+    """
+    runs the mutating API calls of the scripts with a token bucket per region and action,
+    throttling errors are retried with backoff (and slow down the bucket), other errors are raised
+    """
+
+    def __init__(self, rate=API_RATE, retries=API_RETRIES, burst=None):
+        """
+        :param rate: max calls per second per region and action
+        :param retries: max retries of a throttled call
+        :param burst: calls allowed at once before the rate applies, rate when None
+        """
+        self.rate = rate
+        self.retries = retries
+        self.burst = burst
+        self.stats = defaultdict(Counter)  # action -> calls/throttles/retries/errors
+        self._buckets = {}
+        self._lock = Lock()
+
+    def _bucket(self, region, action):
+        with self._lock:
+            if (region, action) not in self._buckets:
+                self._buckets[region, action] = TokenBucket(self.rate, self.burst)
+            return self._buckets[region, action]
+
+    def _count(self, action, stat):
+        with self._lock:
+            self.stats[action][stat] += 1
+
+    def call(self, client, action, **kwargs):
+        """
+        :param client: boto3 client, its region is used for the bucket. a client without botocore retries
+                       (see ClientCache.get retry=False), or botocore retries the throttled calls before this does
+        :param action: client method name, e.g. 'delete_volume'
+        :param kwargs: parameters of the call
+        :return: the call response
+        """
+        from botocore.exceptions import ClientError
+        bucket = self._bucket(client.meta.region_name, action)
+        for attempt in range(self.retries + 1):
+            bucket.take()
+            self._count(action, 'calls')
+            try:
+                response = getattr(client, action)(**kwargs)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLE_CODES:
+                    bucket.succeeded()  # the API answered, e.g. DryRunOperation
+                    raise
+                self._count(action, 'throttles')
+                bucket.throttled()
+                if attempt == self.retries:
+                    self._count(action, 'errors')
+                    raise
+                self._count(action, 'retries')
+                sleep(random.uniform(0, min(20, 0.5 * 2 ** attempt)))  # full jitter backoff
+            else:
+                bucket.succeeded()
+                return response
+
+    def summary(self):
+        """
+        :return: one text line per API action with the calls, throttles and retries, for the end of the run
+        """
+        with self._lock:
+            return [f"{action}: {stats['calls']} calls, {stats['throttles']} throttled, {stats['retries']} retries,"
+                    f" {stats['errors']} gave up" for action, stats in sorted(self.stats.items())]
+
+
+class ClientCache:
+    """
+    one boto3 client per service, region and credentials, shared by all the threads of a script
+    instead of a new client (endpoint resolution, service model loading) per region and pass.
+    boto3 clients are thread safe, creating them is not, so creation is done under a lock.
+    the clients use adaptive retry mode, and enough pooled connections for the worker threads,
+    except the clients of the ApiLimiter calls that retry the throttled calls themselves
+    """
+
+    def __init__(self, pool_size=CLIENT_POOL, retries=CLIENT_RETRIES):
+        """
+        :param pool_size: max_pool_connections of each client
+        :param retries: max attempts of a call, throttled calls are retried and slow down the client
+        """
+        self.pool_size = pool_size
+        self.retries = retries
+        self._clients = {}
+        self._session = None
+        self._lock = Lock()
+
+    def configure(self, pool_size):
+        """
+        set the connection pool size of the clients created from now on, call it before the first client
+        :param pool_size: worker threads that can use the same client at once
+        """
+        with self._lock:
+            self.pool_size = max(CLIENT_POOL, pool_size)
+
+    def get(self, service, region=None, retry=True):
+        """
+        :param service: boto3 service name, e.g. 'ec2'
+        :param region: region name, the session default region when None
+        :param retry: False for a client without botocore retries, for the calls made with ApiLimiter.call
+        :return: the cached boto3 client, created on first use
+        """
+        import boto3
+        from botocore.config import Config
+        with self._lock:
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            if boto3.DEFAULT_SESSION is not self._session:  # e.g. a new default session with other credentials
+                self._session = boto3.DEFAULT_SESSION
+                self._clients.clear()
+            credentials = self._session.get_credentials()
+            key = (service, region, getattr(credentials, 'access_key', None), retry)
+            if key not in self._clients:
+                retries = {'total_max_attempts': self.retries, 'mode': 'adaptive'} if retry else \
+                    {'total_max_attempts': 1, 'mode': 'standard'}
+                config = Config(retries=retries, max_pool_connections=self.pool_size)
+                self._clients[key] = self._session.client(service, region_name=region, config=config)
+            return self._clients[key]
+
+
+clients = ClientCache()  # clients of the run, see ClientCache.get
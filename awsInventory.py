@@ -0,0 +1,220 @@
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from threading import Lock
+import json
+from awsCommon import paginate, get_sg_attachments, clients
+
+# compact records of the fields the scripts use, instead of keeping the raw describe_* responses
+# tags are a dict, or None for untagged resources
+# Instance.volumes is ((volume id, status),) and Instance.security_groups is ((group id, group name),)
+Instance = namedtuple('Instance', 'id type zone private_ip public_dns state subnet_id vpc_id root_device_type '
+                                  'volumes security_groups launch_time tags')
+Volume = namedtuple('Volume', 'id zone state iops type size attached_to delete_on_termination create_time tags')
+Snapshot = namedtuple('Snapshot', 'id volume_id volume_size state start_time tags')
+Image = namedtuple('Image', 'id name owner_id type creation_date snapshot_ids tags')
+SecurityGroup = namedtuple('SecurityGroup', 'id name vpc_id owner_id tags')
+RECORD_TYPES = {record.__name__: record for record in (Instance, Volume, Snapshot, Image, SecurityGroup)}
+KIND_RECORDS = {'instances': Instance, 'volumes': Volume, 'snapshots': Snapshot, 'images': Image,
+                'security_groups': SecurityGroup}
+TIME_FIELDS = {'instances': 'launch_time', 'volumes': 'create_time', 'snapshots': 'start_time'}  # datetime fields
+
+
+def _tags(item):
+    """
+    :return: the Tags list of a describe_* item as dict, None if there are no tags
+    """
+    if not item.get('Tags'):
+        return None
+    return {tag.get('Key'): tag.get('Value') for tag in item['Tags']}
+
+
+def _instance(item):
+    return Instance(item['InstanceId'], item['InstanceType'], item['Placement']['AvailabilityZone'],
+                    item.get('PrivateIpAddress'), item.get('PublicDnsName'), item['State']['Name'],
+                    item.get('SubnetId'), item.get('VpcId'), item['RootDeviceType'],
+                    tuple((device['Ebs']['VolumeId'], device['Ebs']['Status'])
+                          for device in item.get('BlockDeviceMappings', []) if 'Ebs' in device),
+                    tuple((sg['GroupId'], sg['GroupName']) for sg in item.get('SecurityGroups', [])),
+                    item.get('LaunchTime'), _tags(item))
+
+
+def _volume(item):
+    attachments = item.get('Attachments', [])
+    return Volume(item['VolumeId'], item['AvailabilityZone'], item['State'], item.get('Iops'), item['VolumeType'],
+                  item['Size'], tuple(attachment['InstanceId'] for attachment in attachments),
+                  any(attachment.get('DeleteOnTermination') for attachment in attachments), item.get('CreateTime'),
+                  _tags(item))
+
+
+def _snapshot(item):
+    return Snapshot(item['SnapshotId'], item['VolumeId'], item['VolumeSize'], item['State'], item['StartTime'],
+                    _tags(item))
+
+
+def _image(item):
+    snapshot_ids = tuple(device['Ebs']['SnapshotId'] for device in item.get('BlockDeviceMappings', [])
+                         if device.get('Ebs', {}).get('SnapshotId'))
+    return Image(item['ImageId'], item.get('Name'), item['OwnerId'], item['ImageType'], item.get('CreationDate'),
+                 snapshot_ids, _tags(item))
+
+
+def _security_group(item):
+    return SecurityGroup(item['GroupId'], item['GroupName'], item.get('VpcId'), item.get('OwnerId'), _tags(item))
+
+
+def record_from_store(kind, fields):
+    """
+    :param kind: resource type, e.g. 'volumes'
+    :param fields: record saved in the inventoryStore (its _asdict(), the datetimes as text)
+    :return: the awsInventory record
+    """
+    record = KIND_RECORDS[kind](**fields)
+    created = TIME_FIELDS.get(kind)
+    if created and isinstance(fields[created], str):
+        record = record._replace(**{created: datetime.fromisoformat(fields[created])})
+    return record
+
+
+class RegionInventory:
+    """
+    resources of one region. each resource type is fetched once, the first time it is used,
+    and shared by all the planning passes together with the lookups between the types. the
+    inventory is a snapshot of the region before the cleanup, the plan orders the deletions.
+    with a store, the fetched types are saved to it, and with from_cache they are read from it
+    unless they are stale (see inventoryStore.STORE_TTL), then they are fetched and saved again
+    """
+
+    def __init__(self, ec2, account, rules=None, store=None, region=None, from_cache=False):
+        """
+        :param ec2: boto3 ec2 client of the region, used by the passes too. None to create it for region
+                    on first use, so a run from the store does not need AWS credentials or clients
+        :param account: account number in list, owner of the snapshots and images
+        :param rules: dict of type -> selectionRules.Rule, only the resources selected by the rule are
+                      fetched (its filters are sent to EC2), types without a rule are fetched fully
+        :param store: inventoryStore.InventoryStore, None to keep the resources in memory only
+        :param region: region name, the key of the resources in the store
+        :param from_cache: read the types from the store instead of EC2 when they are fresh
+        """
+        self._ec2 = ec2
+        self.account = account
+        self.rules = rules or {}
+        self.store = store
+        self.region = region
+        self.from_cache = from_cache
+        self.refreshed = []  # types fetched from EC2
+        self._lock = Lock()
+        self._resources = {}  # type -> dict of id -> record
+        self._indexes = {}  # lookups between the types, see _index
+
+    @property
+    def ec2(self):
+        if self._ec2 is None:
+            self._ec2 = clients.get('ec2', self.region)
+        return self._ec2
+
+    def _stored(self, kind, rule):
+        """
+        :return: the fresh records of the type in the store, None when they must be fetched
+        """
+        if self.store is None or not self.from_cache:
+            return None
+        return self.store.load(self.region, kind, rule)
+
+    def _save(self, kind, rule, resources):
+        """
+        save the fetched resources to the store
+        :param resources: list of (id, record), see inventoryStore.InventoryStore.save
+        """
+        self.refreshed.append(kind)
+        if self.store is not None:
+            self.store.save(self.region, kind, resources, rule)
+
+    def _get(self, kind):
+        with self._lock:
+            if kind not in self._resources:
+                rule = self.rules.get(kind)
+                filters = {'Filters': rule.filters()} if rule and rule.filters() else {}
+                store_rule = json.dumps(filters, sort_keys=True)
+                stored = self._stored(kind, store_rule)
+                if stored is not None:
+                    items = [record_from_store(kind, fields) for fields in stored]
+                elif kind == 'instances':
+                    items = map(_instance, paginate(self.ec2, 'describe_instances', 'Reservations[].Instances[]',
+                                                    **filters))
+                elif kind == 'volumes':
+                    items = map(_volume, paginate(self.ec2, 'describe_volumes', 'Volumes', page_size=500, **filters))
+                elif kind == 'snapshots':
+                    items = map(_snapshot, paginate(self.ec2, 'describe_snapshots', 'Snapshots',
+                                                    OwnerIds=self.account, **filters))
+                elif kind == 'images':
+                    items = map(_image, paginate(self.ec2, 'describe_images', 'Images', Owners=self.account,
+                                                 **filters))
+                else:
+                    items = map(_security_group, paginate(self.ec2, 'describe_security_groups', 'SecurityGroups',
+                                                          **filters))
+                if stored is None:  # the store keeps what EC2 selected, rule.matches() is checked again on load
+                    items = list(items)
+                    self._save(kind, store_rule, [(item.id, item._asdict()) for item in items])
+                self._resources[kind] = {item.id: item for item in items if not rule or rule.matches(item)}
+            return self._resources[kind]
+
+    @property
+    def instances(self):
+        return self._get('instances')
+
+    @property
+    def volumes(self):
+        return self._get('volumes')
+
+    @property
+    def snapshots(self):
+        return self._get('snapshots')
+
+    @property
+    def images(self):
+        return self._get('images')
+
+    @property
+    def security_groups(self):
+        return self._get('security_groups')
+
+    def _index(self, name, build):
+        """
+        lookup dict built on first use and kept for the run
+        """
+        index = self._indexes.get(name)
+        if index is None:
+            index = self._indexes[name] = build()
+        return index
+
+    def images_of(self, snapshot_id):
+        """
+        :return: ids of the AMIs backed by the snapshot
+        """
+        def build():
+            images_by_snapshot = defaultdict(list)
+            for image in self.images.values():
+                for image_snapshot_id in image.snapshot_ids:
+                    images_by_snapshot[image_snapshot_id].append(image.id)
+            return images_by_snapshot
+
+        return self._index('images_by_snapshot', build).get(snapshot_id, [])
+
+    def attachments_of(self, group_id):
+        """
+        :return: ids of the instances/interfaces using the security group, see awsCommon.get_sg_attachments
+        """
+        def build():
+            rule = self.rules.get('instances')
+            store_rule = json.dumps(rule.filters() if rule else [], sort_keys=True)  # of the instances used
+            stored = self._stored('sg_attachments', store_rule)
+            if stored is not None:
+                return {fields['id']: fields['used_by'] for fields in stored}
+            instance_groups = [(instance.id, [group_id for group_id, name in instance.security_groups])
+                               for instance in self.instances.values()]
+            attachments = get_sg_attachments(self.ec2, instance_groups)
+            self._save('sg_attachments', store_rule, [(group_id, {'id': group_id, 'used_by': used_by})
+                                                      for group_id, used_by in attachments.items()])
+            return attachments
+
+        return self._index('sg_attachments', build).get(group_id, [])
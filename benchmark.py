@@ -0,0 +1,361 @@
+import argparse
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import runpy
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter, strftime
+import boto3
+import apiMetrics
+from awsCommon import setup_logging, log_line
+from sgIndex import SgIndex, parse_port, ALL_PORTS, PORT_PROTOCOLS
+
+os.environ.setdefault('MOTO_EC2_LOAD_DEFAULT_AMIS', 'false')  # else moto adds thousands of public AMIs/snapshots
+try:
+    from moto import mock_aws
+except ImportError:  # moto is only needed for the benchmark, not to run the scripts
+    mock_aws = None
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ACCOUNT = '123456789012'  # moto account
+BENCH_REGIONS = ('us-east-1', 'eu-west-1', 'eu-central-1', 'us-west-2', 'ap-southeast-1', 'eu-north-1', 'us-east-2',
+                 'ap-northeast-1', 'eu-west-2', 'ca-central-1')  # regions known by the scripts and moto
+BLOCK = b'x' * 524288  # one EBS snapshot block
+BLOCK_CHECKSUM = base64.b64encode(hashlib.sha256(BLOCK).digest()).decode()
+
+STARTUP_SCRIPTS = ('cleanResources.py', 'sgReport.py', 'SnapshotStorage.py')
+STARTUP_BUDGET_MS = 100  # max import time of a script started with -h, heavy modules are imported when used
+INDEX_QUERIES = ('22', '3389/tcp', '53/udp', '1000-2000', '8/icmp', '0/icmp')  # checked with and without CIDR
+INDEX_CIDRS = (None, '0.0.0.0/0', '10.1.0.0/16', '10.1.2.3/32')
+
+# benchmark name -> (script, arguments, resource types to seed)
+BENCHMARKS = {
+    'clean_dryrun': ('cleanResources.py', ['-o', 'all', '--dryrun', 'True', '--api_rate', '100000'],
+                     ('snapshots', 'images', 'instances', 'volumes', 'security_groups')),
+    'scan_sg': ('sgReport.py', ['--exposes', '22', '--exposes', '8/icmp', '--from', '0.0.0.0/0'],
+                ('images', 'instances', 'security_groups')),
+    'scan_snapshots': ('SnapshotStorage.py', ['-o', 'sr', '--all_regions', 'True', '--cache', 'False'],
+                       ('snapshots',)),
+}
+
+
+def seed_region(region, sizes, kinds):
+    """
+    create the benchmark resources of one region in moto
+    :param sizes: dict of resource type -> number per region, sg_rules and snapshot_blocks
+    :param kinds: resource types to create, see BENCHMARKS
+    """
+    ec2 = boto3.client('ec2', region_name=region)
+    snapshot_ids = []
+    if 'snapshots' in kinds:  # with the EBS direct API, so SnapshotStorage can count their blocks
+        ebs = boto3.client('ebs', region_name=region)
+        for _ in range(sizes['snapshots']):
+            snapshot_id = ebs.start_snapshot(VolumeSize=1)['SnapshotId']
+            for index in range(sizes['snapshot_blocks']):
+                ebs.put_snapshot_block(SnapshotId=snapshot_id, BlockIndex=index, BlockData=BLOCK,
+                                       DataLength=len(BLOCK), Checksum=BLOCK_CHECKSUM, ChecksumAlgorithm='SHA256')
+            ebs.complete_snapshot(SnapshotId=snapshot_id, ChangedBlocksCount=sizes['snapshot_blocks'])
+            snapshot_ids.append(snapshot_id)
+
+    image_ids = []
+    if 'images' in kinds:
+        for i in range(max(1, sizes['images'])):  # instances need an image
+            image_ids.append(ec2.register_image(Name=f'bench-{i}', RootDeviceName='/dev/sda1')['ImageId'])
+        if sizes['images'] > 1:
+            ec2.create_tags(Resources=image_ids[:sizes['images'] // 2], Tags=[{'Key': 'keep', 'Value': 'on'}])
+
+    group_ids = []
+    if 'security_groups' in kinds:
+        for i in range(sizes['security_groups']):
+            group_id = ec2.create_security_group(GroupName=f'bench-{i}', Description='benchmark')['GroupId']
+            group_ids.append(group_id)
+            permissions = [{'IpProtocol': 'tcp', 'FromPort': 1000 + rule, 'ToPort': 1000 + rule,
+                            'IpRanges': [{'CidrIp': f'10.{rule % 256}.0.0/16'}]} for rule in range(sizes['sg_rules'])]
+            permissions += [{'IpProtocol': 'icmp', 'FromPort': 8, 'ToPort': -1,  # ping, ICMP type 8 any code
+                             'IpRanges': [{'CidrIp': '0.0.0.0/0'}]},
+                            {'IpProtocol': 'icmp', 'FromPort': -1, 'ToPort': -1,
+                             'IpRanges': [{'CidrIp': '10.0.0.0/8'}]}]
+            if permissions:
+                ec2.authorize_security_group_ingress(GroupId=group_id, IpPermissions=permissions)
+
+    if 'instances' in kinds and sizes['instances']:
+        groups = {'SecurityGroupIds': group_ids[:1]} if group_ids else {}  # the other groups stay unused
+        instances = ec2.run_instances(ImageId=image_ids[0], MinCount=sizes['instances'], MaxCount=sizes['instances'],
+                                      **groups)['Instances']
+        instance_ids = [instance['InstanceId'] for instance in instances]
+        ec2.create_tags(Resources=instance_ids[0::3], Tags=[{'Key': 'keep', 'Value': 'on'}])
+        ec2.create_tags(Resources=instance_ids[1::3], Tags=[{'Key': 'keep', 'Value': 'off'}])
+
+    if 'volumes' in kinds:
+        for _ in range(sizes['volumes']):
+            ec2.create_volume(AvailabilityZone=f'{region}a', Size=1, VolumeType='gp2')
+
+
+def run_benchmark(name, regions, sizes, workers, memory=True):
+    """
+    seed a fresh moto account and run one script end to end in a temporary directory (config.txt,
+    reports and logs), its console output is hidden
+    :param name: one of BENCHMARKS
+    :param regions: region names
+    :param sizes: see seed_region
+    :param workers: --workers of the script
+    :param memory: trace the peak memory with tracemalloc (slows the run, moto allocations are included)
+    :return: dict of the results
+    """
+    script, script_args, kinds = BENCHMARKS[name]
+    with mock_aws(), tempfile.TemporaryDirectory() as work_dir:
+        for region in regions:
+            seed_region(region, sizes, kinds)
+        with open(os.path.join(work_dir, 'config.txt'), 'w') as config:
+            config.write(f"[ec2_region]\nAll = false\nregions = {', '.join(regions)}\n\n"
+                         f"[aws_details]\naws_account={ACCOUNT}\n")
+
+        apiMetrics.metrics = apiMetrics.ApiMetrics()
+        boto3.DEFAULT_SESSION = None  # the script registers the metrics hooks in a new default session
+        if script == 'SnapshotStorage.py':
+            script_args = script_args + ['--workers', str(workers), '--region_workers', str(workers)]
+        elif script == 'cleanResources.py':
+            script_args = script_args + ['--workers', str(workers)]
+        argv, cwd = sys.argv, os.getcwd()
+        sys.argv = [script] + script_args
+        os.chdir(work_dir)
+        if memory:
+            tracemalloc.start()
+        start = perf_counter()
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                runpy.run_path(os.path.join(SCRIPTS_DIR, script), run_name='__main__')
+        finally:
+            seconds = perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if memory else None
+            tracemalloc.stop()
+            sys.argv = argv
+            os.chdir(cwd)
+
+    calls = {}
+    for stats in apiMetrics.metrics.to_dict()['calls']:
+        operation = f"{stats['service']}.{stats['operation']}"
+        calls[operation] = calls.get(operation, 0) + stats['calls']
+    return {'seconds': round(seconds, 3), 'peak_memory_mb': round(peak / 2 ** 20, 1) if memory else None,
+            'api_calls': sum(calls.values()), 'calls_by_operation': calls}
+
+
+def startup_benchmark(script, runs=3):
+    """
+    measure the start of a script with python -X importtime SCRIPT -h, in a new process each time
+    :param script: one of STARTUP_SCRIPTS
+    :param runs: the fastest of the runs is kept
+    :return: dict with the import time (sum of the top level imports), the wall time and the slowest imports
+    """
+    best = None
+    for _ in range(runs):
+        start = perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(SCRIPTS_DIR, script), '-h'],
+                                 capture_output=True, text=True, cwd=tempfile.gettempdir())
+        wall_ms = (perf_counter() - start) * 1000
+        imports = {}  # top level module -> cumulative us
+        for line in process.stderr.splitlines():
+            if line.startswith('import time:'):
+                _, cumulative, name = line.split('|')
+                if cumulative.strip().isdigit() and name.startswith(' ') and not name.startswith('  '):
+                    imports[name.strip()] = int(cumulative)
+        import_ms = sum(imports.values()) / 1000
+        if best is None or import_ms < best['import_ms']:
+            best = {'import_ms': round(import_ms, 1), 'wall_ms': round(wall_ms, 1), 'budget_ms': STARTUP_BUDGET_MS,
+                    'slowest_imports': dict(sorted(imports.items(), key=lambda item: -item[1])[:5])}
+    return best
+
+
+def _index_rows(rules, seed=1):
+    """
+    :return: random sgReport rows: tcp/udp port ranges, All traffic, ICMP types (ToPort -1, the code) and
+             all ICMP (N/A ports), from CIDRs, prefix lists and security groups
+    """
+    rand = random.Random(seed)
+    rows = []
+    for i in range(rules):
+        kind = rand.random()
+        if kind < 0.05:
+            protocol, from_port, to_port = 'All', 'All', 'All'
+        elif kind < 0.15:
+            protocol, from_port, to_port = 'icmp', *rand.choice(((8, -1), (0, -1), (3, 4), ('N/A', 'N/A')))
+        else:
+            from_port = rand.randrange(65536)
+            protocol, to_port = rand.choice(('tcp', 'udp')), min(65535, from_port + rand.choice((0, 0, 10, 1000)))
+        source = rand.random()
+        if source < 0.01:
+            source = '0.0.0.0/0'
+        elif source < 0.05:
+            source = rand.choice(('pl-1234', 'sg-1234'))
+        else:
+            source = f'10.{rand.randrange(4)}.{rand.randrange(256)}.0/{rand.choice((16, 24, 28))}'
+        rows.append({'SG Id': f'sg-{i}', 'IpProtocol': protocol, 'FromPort': from_port, 'ToPort': to_port,
+                     'Source': source})
+    return rows
+
+
+def _index_matches(row, low, high, protocol, cidr):
+    """
+    brute force answer of SgIndex.query for one row
+    """
+    from ipaddress import ip_network
+    rule_protocol = row['IpProtocol'].lower()
+    if rule_protocol != 'all' and (rule_protocol != protocol if protocol else rule_protocol not in PORT_PROTOCOLS):
+        return False
+    if not isinstance(row['FromPort'], int) or row['FromPort'] < 0:
+        ports = ALL_PORTS
+    else:
+        ports = (row['FromPort'], row['ToPort'] if rule_protocol in PORT_PROTOCOLS else row['FromPort'])
+    if ports[0] > high or ports[1] < low:
+        return False
+    if cidr is None:
+        return True
+    try:
+        source = ip_network(row['Source'], strict=False)
+    except ValueError:  # prefix list or security group
+        return False
+    query = ip_network(cidr, strict=False)
+    return source.version == query.version and query.subnet_of(source)
+
+
+def index_benchmark(rules):
+    """
+    time the SgIndex queries on random rules and check their results against a brute force scan
+    :param rules: number of rules
+    :return: dict of the results, 'mismatches' lists the queries with a wrong answer
+    """
+    rows = _index_rows(rules)
+    start = perf_counter()
+    index = SgIndex()
+    for row in rows:
+        index.add(row)
+    index.freeze()
+    result = {'rules': rules, 'build_ms': round((perf_counter() - start) * 1000, 1), 'query_ms': {},
+              'mismatches': []}
+    for port in INDEX_QUERIES:
+        low, high, protocol = parse_port(port)
+        for cidr in INDEX_CIDRS:
+            start = perf_counter()
+            found = index.query(low, high, protocol, cidr)
+            result['query_ms'][f"{port} from {cidr or 'any'}"] = round((perf_counter() - start) * 1000, 3)
+            expected = {id(row) for row in rows if _index_matches(row, low, high, protocol, cidr)}
+            if {id(row) for row in found} != expected or len(found) != len(expected):
+                result['mismatches'].append(f"{port} from {cidr or 'any'}")
+    return result
+
+
+def compare(results, baseline_file):
+    """
+    log the change of each benchmark against the results of a previous run
+    :param results: run_benchmark results by name
+    :param baseline_file: json file written by a previous benchmark run
+    """
+    with open(baseline_file) as file:
+        baseline = json.load(file)['results']
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('seconds', 'peak_memory_mb', 'api_calls', 'import_ms'):
+            before, after = baseline[name].get(metric), result.get(metric)
+            if before and after is not None:
+                _log(f"INFO: {name} {metric}: {before} -> {after} ({(after - before) / before * 100:+.1f}%)")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPTS_DIR, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+logger = setup_logging('benchmark')
+
+
+def _log(line, *args):
+    """
+    log to console, see awsCommon.log_line
+    """
+    log_line(logger, line, *args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the AWS scripts against moto, an in-process AWS stand-in')
+    parser.add_argument('--benchmark', '-b', type=str, choices=tuple(BENCHMARKS), action='append',
+                        help='benchmark to run, can be repeated (default all)')
+    parser.add_argument('--regions', type=int, default=2, help=f'number of regions, max {len(BENCH_REGIONS)}')
+    parser.add_argument('--instances', type=int, default=20, help='EC2 instances per region')
+    parser.add_argument('--volumes', type=int, default=50, help='available volumes per region')
+    parser.add_argument('--snapshots', type=int, default=50, help='snapshots per region')
+    parser.add_argument('--snapshot_blocks', type=int, default=4, help='blocks of each snapshot')
+    parser.add_argument('--images', type=int, default=5, help='AMIs per region, half are tagged keep')
+    parser.add_argument('--security_groups', type=int, default=20, help='security groups per region')
+    parser.add_argument('--sg_rules', type=int, default=10, help='inbound rules of each security group')
+    parser.add_argument('--workers', '-w', type=int, default=4, help='--workers of the scripts')
+    parser.add_argument('--memory', metavar='Bool', type=str, default='True',
+                        help='trace the peak memory, slows the runs (default True)')
+    parser.add_argument('--startup', metavar='Bool', type=str, default='True',
+                        help=f'measure the start time of the scripts (-X importtime), fails above '
+                             f'{STARTUP_BUDGET_MS} ms of imports (default True)')
+    parser.add_argument('--index', metavar='Bool', type=str, default='True',
+                        help='time the sgReport --exposes queries (sgIndex) on random rules and check them against '
+                             'a brute force scan, fails on a wrong answer (default True)')
+    parser.add_argument('--index_rules', type=int, default=100000, help='rules of the index benchmark')
+    parser.add_argument('--output', '-o', type=str, help='results json file (default benchmark_<time>.json)')
+    parser.add_argument('--compare', type=str, help='results json file of a previous run to compare with')
+    args = parser.parse_args()
+    results = {}
+
+    over_budget = []
+    if args.startup == 'True':
+        for script in STARTUP_SCRIPTS:
+            name = f"startup_{script[:-3]}"
+            results[name] = startup_benchmark(script)
+            _log(f"INFO: {name}: {results[name]['import_ms']} ms of imports (budget {STARTUP_BUDGET_MS} ms), "
+                 f"{results[name]['wall_ms']} ms to run -h")
+            if results[name]['import_ms'] > STARTUP_BUDGET_MS:
+                over_budget.append(name)
+                _log(f"ERROR: {name} is over the startup budget, slowest imports "
+                     f"{results[name]['slowest_imports']}")
+
+    wrong_answers = []
+    if args.index == 'True':
+        results['index_sg'] = index_benchmark(args.index_rules)
+        _log(f"INFO: index_sg: {args.index_rules} rules indexed in {results['index_sg']['build_ms']} ms, "
+             f"slowest query {max(results['index_sg']['query_ms'].values())} ms")
+        wrong_answers = results['index_sg']['mismatches']
+        if wrong_answers:
+            _log(f"ERROR: index_sg: wrong answers for {wrong_answers}")
+
+    if mock_aws is None:
+        _log('ERROR: moto is needed for the benchmark - pip install moto')
+        sys.exit(1)
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    sizes = {kind: getattr(args, kind) for kind in ('instances', 'volumes', 'snapshots', 'snapshot_blocks', 'images',
+                                                      'security_groups', 'sg_rules')}
+    regions = list(BENCH_REGIONS[:max(1, args.regions)])
+    for name in args.benchmark or BENCHMARKS:
+        _log(f"INFO: Running {name} - {len(regions)} regions, {sizes}")
+        results[name] = run_benchmark(name, regions, sizes, args.workers, args.memory == 'True')
+        _log(f"INFO: {name}: {results[name]['seconds']}s, {results[name]['api_calls']} API calls, "
+             f"peak memory {results[name]['peak_memory_mb']} MB")
+
+    output = args.output or strftime('benchmark_%Y-%b-%d_%H-%M-%S.json')
+    with open(output, 'w') as file:
+        json.dump({'time': strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _git_commit(), 'python': platform.python_version(),
+                   'regions': regions, 'sizes': sizes, 'workers': args.workers, 'results': results}, file, indent=1)
+    _log(f"INFO: Results saved - {output}")
+    if args.compare:
+        compare(results, args.compare)
+    if over_budget or wrong_answers:
+        sys.exit(1)
@@ -1,28 +1,182 @@
 from azure.mgmt.resource import SubscriptionClient, ResourceManagementClient
 from azure.identity import ClientSecretCredential
+from azure.core.exceptions import AzureError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from time import perf_counter, strftime
+import argparse
+import configparser
+import os
+from awsCommon import setup_logging, log_line, LOG_LEVELS
 
-client_secret = '1'
-client_id = '2'
-tenant_id ='3'
-subscription_id = '4'
+DELETE_TIMEOUT = 1800  # seconds to wait for the deletion of a resource group
 
-credential = ClientSecretCredential(tenant_id=tenant_id, client_id=client_id, client_secret=client_secret)
-subscription_client = SubscriptionClient(credential)
 
-for sub in subscription_client.subscriptions.list():
-    print(sub)
-    print(sub.__getattribute__('subscription_id'))
+def get_config_azure():
+    """
+    read the azure details from config.txt, the client secret can be given in the AZURE_CLIENT_SECRET
+    environment variable instead of the file
+    :return: dict with tenant_id, client_id, client_secret, subscriptions (empty for all), keep_tag and
+             keep_values (empty for any value)
+    """
+    _log('INFO: Checking azure config')
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+    details = config['azure_details']
+    return {'tenant_id': details['tenant_id'],
+            'client_id': details['client_id'],
+            'client_secret': os.environ.get('AZURE_CLIENT_SECRET') or details.get('client_secret'),
+            'subscriptions': [sub.strip() for sub in details.get('subscriptions', 'all').split(',')
+                              if sub.strip() and sub.strip().lower() != 'all'],
+            'keep_tag': details.get('keep_tag', 'keep'),
+            'keep_values': [value.strip() for value in details.get('keep_values', '').split(',') if value.strip()]}
 
-resource_client = ResourceManagementClient(credential, subscription_id)
-group_list = resource_client.resource_groups.list()
 
-for RG in group_list:
-    if RG.__getattribute__('tags') is None :
-        print('Deleting Name: ' + RG.__getattribute__('name'))
-        delete_async_operation = resource_client.resource_groups.begin_delete(RG.__getattribute__('name'))
+def keep_group(tags):
+    """
+    :param tags: tags of the resource group, None when it has none
+    :return: True if the keep tag (with one of the keep values, if any are configured) is on the group
+    """
+    if not tags or azure['keep_tag'] not in tags:
+        return False
+    return not azure['keep_values'] or tags[azure['keep_tag']] in azure['keep_values']
 
-    elif 'keep' not in RG.__getattribute__('tags'):
-        print('Deleting Name: ' + RG.__getattribute__('name')  + ', Tag ' + str(RG.__getattribute__('tags')) )
-        delete_async_operation = resource_client.resource_groups.begin_delete(RG.__getattribute__('name'))
 
-    else: print('keeping: ' + RG.__getattribute__('name'))
+class RgReport:
+    """
+    xlsx report of the resource groups, opened in write-only mode and saved once by close()
+    """
+    headers = ("Subscription", "ResourceGroup", "Location", "Tags", "Action", "Duration(s)", "Errors")
+
+    def __init__(self, file_name):
+        from openpyxl import Workbook  # slow to import, only when a report is written
+        self.file_name = file_name
+        self._lock = Lock()  # rows come from the subscription and deletion threads
+        self._wb = Workbook(write_only=True)
+        self._ws = self._wb.create_sheet('ResourceGroups')
+        self._ws.append(self.headers)
+
+    def append(self, row):
+        """
+        :param row: tuple matching RgReport.headers
+        """
+        with self._lock:
+            self._ws.append(row)
+
+    def close(self):
+        with self._lock:
+            self._wb.save(self.file_name)
+
+
+def delete_group(resource_client, subscription_id, group, dry_run, timeout):
+    """
+    delete a resource group and wait for the deletion to finish, the row is added to the report
+    :param resource_client: ResourceManagementClient of the subscription
+    :param group: resource group from resource_groups.list()
+    :param dry_run: only report the group, don't delete it
+    :param timeout: seconds to wait for the deletion poller
+    :return: action done, Deleted / DryRun / Timeout / Failed
+    """
+    start = perf_counter()
+    action, error = 'DryRun', None
+    if not dry_run:
+        try:
+            poller = resource_client.resource_groups.begin_delete(group.name)
+            poller.wait(timeout)
+            if poller.done():
+                poller.result()  # raises the error of a failed deletion
+                action = 'Deleted'
+            else:  # Azure goes on deleting the group, the next run will see it if it fails
+                action, error = 'Timeout', f"still deleting after {timeout}s ({poller.status()})"
+        except AzureError as e:
+            action, error = 'Failed', str(e)
+    duration = round(perf_counter() - start, 1)
+    _log(f"{'ERROR' if error else 'INFO'}: {subscription_id}: {action} {group.name} ({duration}s)"
+         + (f" - {error}" if error else ''))
+    report.append((subscription_id, group.name, group.location, str(group.tags), action, duration, error))
+    return action
+
+
+def clean_subscription(subscription_id, deletions, dry_run, timeout):
+    """
+    list the resource groups of a subscription, the groups without the keep tag are submitted for deletion
+    :param deletions: executor running the deletions of all the subscriptions, bounds how many run at once
+    :return: list of the futures of the deletions
+    """
+    resource_client = ResourceManagementClient(credential, subscription_id)
+    futures = []
+    for group in resource_client.resource_groups.list():
+        if keep_group(group.tags):
+            _log(f"INFO: {subscription_id}: keeping {group.name}")
+            report.append((subscription_id, group.name, group.location, str(group.tags), 'Kept', None, None))
+            continue
+        _log(f"INFO: {subscription_id}: deleting {group.name}, tags {group.tags}")
+        futures.append(deletions.submit(delete_group, resource_client, subscription_id, group, dry_run, timeout))
+    return futures
+
+
+def clean(dry_run, workers, timeout):
+    """
+    clean the resource groups of the configured subscriptions (all the subscriptions of the credential
+    when none are configured). the subscriptions are listed in parallel and their deletions share one
+    pool of workers, each deletion waits on its poller up to timeout
+    :return: dict of action -> number of resource groups
+    """
+    subscriptions = azure['subscriptions'] or [sub.subscription_id for sub in
+                                               SubscriptionClient(credential).subscriptions.list()]
+    _log(f"INFO: Cleaning subscriptions - {subscriptions}")
+    counts = {}
+    with ThreadPoolExecutor(max_workers=workers) as deletions, \
+            ThreadPoolExecutor(max_workers=min(workers, len(subscriptions)) or 1) as listing:
+        listings = {listing.submit(clean_subscription, sub, deletions, dry_run, timeout): sub for sub in subscriptions}
+        futures = []
+        for future in as_completed(listings):
+            try:
+                futures += future.result()
+            except AzureError as e:  # keep the other subscriptions running
+                _log(f"ERROR: subscription {listings[future]} failed: {e}")
+                report.append((listings[future], None, None, None, 'Failed', None, str(e)))
+                counts['FailedSubscriptions'] = counts.get('FailedSubscriptions', 0) + 1
+        for future in as_completed(futures):
+            counts[future.result()] = counts.get(future.result(), 0) + 1
+    return counts
+
+
+logger = setup_logging('cleanRG')
+
+
+def _log(line, *args):
+    """
+    used instead of print, can log to console and/or log file, see awsCommon.log_line
+    :param line: line to be printed to log
+    """
+    log_line(logger, line, *args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete the Azure resource groups without the keep tag of the '
+                                                 'config.txt subscriptions')
+    parser.add_argument('--dryrun', metavar='Bool', type=str,
+                        help='only report the resource groups that would be deleted')
+    parser.add_argument('--workers', '-w', type=int, default=8,
+                        help='number of resource groups deleted at the same time (default 8)')
+    parser.add_argument('--timeout', type=int, default=DELETE_TIMEOUT,
+                        help=f'seconds to wait for each resource group deletion (default {DELETE_TIMEOUT})')
+    parser.add_argument('--log', metavar='Bool', type=str,
+                        help='Will create logs file for the CLI Operations')
+    parser.add_argument('--log_level', type=str, choices=LOG_LEVELS, default='INFO',
+                        help='DEBUG also logs the Azure responses (default INFO)')
+    args = parser.parse_args()
+
+    run_id = strftime("%Y-%b-%d_%H-%M-%S")
+    logger = setup_logging('cleanRG', f'RG_log_{run_id}.log' if args.log == 'True' else None, level=args.log_level)
+    azure = get_config_azure()
+    credential = ClientSecretCredential(tenant_id=azure['tenant_id'], client_id=azure['client_id'],
+                                        client_secret=azure['client_secret'])
+    report = RgReport(f'RG_Cleaner_{run_id}.xlsx')
+    try:
+        results = clean(args.dryrun == 'True', max(1, args.workers), args.timeout)
+        _log(f"INFO: Resource groups - {results}")
+    finally:
+        report.close()
+        _log(f"INFO: Report saved - {report.file_name}")
@@ -1,9 +1,26 @@
-import boto3
 from time import strftime
 import configparser
-from botocore.exceptions import ClientError, WaiterError
-from openpyxl import Workbook, load_workbook
 import argparse
+import sys
+from threading import Lock
+from awsCommon import run_per_region, setup_logging, close_logging, log_line, clients, ApiLimiter, LOG_LEVELS, \
+    API_RATE
+from apiMetrics import metrics, instrument, start_profile, report_metrics
+from awsInventory import RegionInventory, RECORD_TYPES
+from deletionPlan import DeletionPlan
+from selectionRules import Rule
+from instancePoller import InstancePoller
+from runJournal import RunJournal, read_journal
+from reportDelivery import share_reports, SES_REGION
+from inventoryStore import InventoryStore
+
+EC2_BATCH = 100  # instances per stop_instances/terminate_instances call
+# plan node kind -> inventoryStore types it changes, expired before a real run deletes anything
+STORE_KINDS = {'EC2': ('instances', 'sg_attachments', 'report_sg_attachments'), 'Volumes': ('volumes',),
+               'Images': ('images',), 'Snapshots': ('snapshots',),
+               'SG': ('security_groups', 'sg_attachments', 'report_security_groups', 'report_sg_attachments')}
+ID_PARAMS = {'delete_volume': 'VolumeId', 'deregister_image': 'ImageId', 'delete_snapshot': 'SnapshotId',
+             'delete_security_group': 'GroupId'}  # delete API call -> its resource id parameter
 
 
 def get_config_regions():
@@ -46,335 +63,497 @@ def get_config_account():
     return account_details
 
 
-def clean_ec2(dry_run=True):
-    _log("INFO: Starting EC2 cleaning")
+def get_rules(older_than=None):
+    """
+    resources the cleanup looks at, the states are selected by EC2 (Filters) and the age after describe_*.
+    there is no EC2 filter for a missing keep tag so the keep tag is checked when planning
+    :param older_than: days, only clean resources created more than this ago, None for all
+    :return: dict of inventory type -> selectionRules.Rule
+    """
+    return {'instances': Rule('instances', states=('pending', 'running', 'stopping', 'stopped'),
+                              older_than=older_than),
+            'volumes': Rule('volumes', states=('available', 'in-use'), older_than=older_than),
+            'snapshots': Rule('snapshots', older_than=older_than),
+            'images': Rule('images', older_than=older_than)}
 
-    # going over each region configured and checking for EC2
-    for region in regions:
-        _log(f"INFO: Checking EC2 instances in region - {region}")
 
-        stop_list = []  # will store list of EC2 to be shutdown
-        terminate_list = []  # will store list of EC2 to be terminated
+def get_inventory(region):
+    """
+    inventory of the region shared by all the cleaning passes, created on first use
+    :param region: region name
+    :return: awsInventory.RegionInventory
+    """
+    with _inventories_lock:
+        if region not in inventories:
+            # all the AMIs are needed to know which snapshots are in use, the images rule is checked when planning
+            inventory_rules = {kind: rule for kind, rule in rules.items() if kind != 'images'}
+            # the ec2 client is created on first use, a run from a fresh store needs none
+            inventories[region] = RegionInventory(None, account, inventory_rules, store, region, from_cache)
+        return inventories[region]
 
-        ec2 = boto3.client('ec2', region_name=region.strip())
-        response = ec2.describe_instances()
-        ec2_instances = [i for instance in response['Reservations'] for i in
-                         instance['Instances']]  # extract the list of instances from the response
-        if not ec2_instances:
-            _log(f'WARNING: region {region}: No EC2 instances found')
-        else:
-            _log(f'INFO: region {region}: Found EC2 instances')
-            for instance in ec2_instances:
-
-                # get tags and check what operation need to be done
-                if not instance.get('Tags'):
-                    Tags = 'N/A'
-                    operation = 'Terminate'
-                else:
-                    Tags = {tag.get('Key'): tag.get('Value') for tag in instance.get('Tags')}
-                    if Tags.get('keep') == 'on':
-                        operation = 'DoNothing'
-                    elif Tags.get('keep') == 'off':
-                        operation = 'Shutdown'
-                    else:
-                        operation = 'Terminate'
-
-                _log(f"INFO: instance: {instance}")
-                print_results_xlsx(data=instance, sheetname='EC2', Tags=str(Tags), OperationDone=operation)
-
-                if operation == 'Shutdown':
-                    stop_list.append(instance['InstanceId'])
-                elif operation == 'Terminate':
-                    terminate_list.append(instance['InstanceId'])
-
-            if stop_list:  # stop the instances
-                _log(f'INFO: Stopping in region{region}: {stop_list}')
-                try:
-                    response = ec2.stop_instances(InstanceIds=stop_list, DryRun=dry_run)
-                    _log(f"INFO: Stopping instance response {response}")
-                except ClientError as e:
-                    _log(f"ERROR: {e}")
-
-                    print_results_xlsx(data=str(stop_list), sheetname='EC2', OperationDone='ERROR-Shutdown',
-                                       error=str(e))
-
-            if terminate_list:  # terminate the instances
-                _log(f'INFO: Terminating in region{region}: {terminate_list}')
-                try:
-                    response = ec2.terminate_instances(InstanceIds=terminate_list, DryRun=dry_run)
-                    _log(f"INFO: terminate instance response {response}")
-                except ClientError as e:  # probably some permission error
-                    _log(f"ERROR: {e}")
-                    print_results_xlsx(data=str(terminate_list), sheetname='EC2', OperationDone='ERROR-Terminate',
-                                       error=str(e))
-                else:  # if termination raised no error, check if it finished (as volume are depended on this)
-                    try:
-                        waiter = ec2.get_waiter('instance_terminated')
-                        waiter.wait(InstanceIds=terminate_list, WaiterConfig={'Delay': 15, 'MaxAttempts': 12},
-                                    DryRun=dry_run)
-                    except WaiterError as e:
-                        _log(f"ERROR: {e}")
-                        print_results_xlsx(data=str(terminate_list), sheetname='EC2',
-                                           OperationDone='ERROR-waitTerminate',
-                                           error=str(e))
-
-        _log(f"INFO: region end: {region}")
-    _log("INFO: existing clean_ec2()")
-
-
-def clean_snapshot(dry_run=True):
-    """
-    check for snapshot in all region and delete them all
-    :param dry_run: for BOTO3 call
+
+def _failed(node):
     """
-    _log("INFO: entering clean_snapshot()")
-    account = get_config_account()
-    for region in regions:
-        _log(f'INFO: Cleaning all snapshots for {region}')
-        ec2 = boto3.client('ec2', region_name=region.strip())
-        response = ec2.describe_snapshots(OwnerIds=account)
-        _log(f'describe_snapshots response {response}')
-        for snap in response['Snapshots']:
-            try:
-                _log(f"INFO: Found {snap['SnapshotId']} for volume: {snap['VolumeId']}, size {snap['VolumeSize']} GB")
-                ec2.delete_snapshot(SnapshotId=snap['SnapshotId'], DryRun=dry_run)
-            except ClientError as e:
-                _log(f'ERROR: {e}')
-                print_results_xlsx(data=snap, sheetname='Snapshots', region=region, error=e)
-            else:
-                print_results_xlsx(data=snap, sheetname='Snapshots', region=region)
-    _log("INFO: existing clean_snapshot()")
-
-
-def clean_volumes(dry_run=True):
-    """
-    check for volumes in all regions and delete all state=available volumes
-    :param dry_run: for BOTO 3 call
-    """
-    _log("INFO: entering clean_volumes()")
-    for region in regions:
-        _log(f'INFO: Cleaning available volumes for {region}')
-        ec2 = boto3.client('ec2', region_name=region.strip())
-        response = ec2.describe_volumes()
-        for volume in response['Volumes']:
-            try:
-
-                Tags = volume.get('Tags')
-                if Tags:
-                    Tags = {tag.get('Key'): tag.get('Value') for tag in Tags}
-                _log(
-                    f"INFO: Found volume in {volume['AvailabilityZone']}: {volume['VolumeId']}({volume['State']},"
-                    f" {volume['Iops']} IOPS, {volume['VolumeType']}) with Tag: {Tags}"
-                )
-                state = 'Nothing'
-
-                if volume['State'] == 'available':
-                    state = 'Terminate'
-                    _log('INFO: Deleting Volume')
-                    ec2.delete_volume(VolumeId=volume['VolumeId'], DryRun=dry_run)
-            except ClientError as e:
-                _log(f'ERROR: {e}')
-                print_results_xlsx(data=volume, sheetname='Volumes', Tags=Tags, OperationDone=state, error=e)
-            else:
-                print_results_xlsx(data=volume, sheetname='Volumes', Tags=Tags, OperationDone=state)
+    :param node: deletionPlan.PlanNode after its action
+    :return: False if the resource was deleted, or would have been without DryRun
+    """
+    from botocore.exceptions import ClientError
+    error = node.error
+    return error is not None and not (isinstance(error, ClientError) and
+                                      error.response['Error']['Code'] == 'DryRunOperation')
 
-    _log("INFO: existing clean_volumes()")
 
+def get_poller(region):
+    """
+    :param region: region name
+    :return: instancePoller.InstancePoller of the region, created on first use
+    """
+    with _inventories_lock:
+        if region not in pollers:
+            pollers[region] = InstancePoller(clients.get('ec2', region))
+        return pollers[region]
 
-def clean_images(dry_run=True):
+
+def _action(region, operation, resource_id, dry_run):
+    """
+    function doing one plan action, built from what the journal records so --resume can rebuild it
+    :param operation: EC2 API call (see ID_PARAMS), stop/terminate_instances or wait_<instance state>
+    :param resource_id: resource id, list of instance ids for stop/terminate_instances
     """
-    check for AMI's in all regions and Deregister if there is no tag keep
-    :param dry_run: for BOTO 3 call
+    ec2 = clients.get('ec2', region, retry=False)  # the limiter retries the throttled calls, not botocore
+    if operation in ('stop_instances', 'terminate_instances'):
+        def action():  # in batches of EC2_BATCH instances
+            for i in range(0, len(resource_id), EC2_BATCH):
+                batch = resource_id[i:i + EC2_BATCH]
+                _log(f"INFO: {'Stopping' if operation == 'stop_instances' else 'Terminating'} in region{region}: "
+                     f"{batch}")
+                response = limiter.call(ec2, operation, InstanceIds=batch, DryRun=dry_run)
+                _log(f'DEBUG: {operation} response %s', response)
+        return action
+    if operation.startswith('wait_'):  # nothing to wait for in DryRun
+        return lambda: None if dry_run else get_poller(region).watch(resource_id, operation[len('wait_'):])
+    return lambda: limiter.call(ec2, operation, DryRun=dry_run, **{ID_PARAMS[operation]: resource_id})
+
+
+def _add_action(plan, key, region, kind, operation, resource_id, dry_run, deps=(), rows=()):
     """
+    add an action to the plan and to the journal, see deletionPlan.DeletionPlan.add.
+    an action done by the resumed run is not run again, it returns its journaled result,
+    and the actions of a --from_cache run do nothing
+    """
+    if key in completed:
+        result = completed[key]
+        action = lambda: result
+    elif from_cache:  # the plan is only reported, nothing is sent to AWS
+        action = lambda: None
+    else:
+        action = _action(region, operation, resource_id, dry_run)
+    plan.add(key, region, kind, resource_id, action, deps, rows)
+    journal.write('planned', key=key, region=region, kind=kind, operation=operation, resource_id=resource_id,
+                  deps=list(deps), rows=[_row_record(row) for row in rows])
 
-    _log("INFO: entering clean_images()")
-    account = get_config_account()
-    for region in regions:
-        _log(f'INFO: Cleaning available images for {region}')
-        ec2 = boto3.client('ec2', region_name=region.strip())
-        images = ec2.describe_images(Owners=account)
-        if not images['Images']:
-            _log(f'WARNING: no images found for {region}')
-        else:
-            for img in images['Images']:
-                try:
-                    OperationDone = ''
-                    Tags = img.get('Tags')
-                    if Tags:
-                        Tags = {tag.get('Key'): tag.get('Value') for tag in Tags}
 
-                        if 'keep' in Tags:
-                            OperationDone = "Keep"
-                        else:
+def _row_record(row):
+    """
+    :param row: print_results_xlsx arguments
+    :return: the row as json serializable dict, see _row_from_record
+    """
+    data = row.get('data')
+    if hasattr(data, '_asdict'):  # awsInventory record
+        row = dict(row, data=dict(data._asdict(), record=type(data).__name__))
+    return row
 
-                            OperationDone = "Deregister"
-                            ec2.deregister_image(ImageId=img['ImageId'], DryRun=dry_run)
 
-                    else:
+def _row_from_record(record):
+    data = record.get('data')
+    if isinstance(data, dict) and 'record' in data:
+        fields = dict(data)
+        record = dict(record, data=RECORD_TYPES[fields.pop('record')](**fields))
+    return record
 
-                        OperationDone = "Deregister"
-                        ec2.deregister_image(ImageId=img['ImageId'], DryRun=dry_run)
 
-                except ClientError as e:
-                    print_results_xlsx(data=img, sheetname='Images', region=region, OperationDone=OperationDone,
-                                       Tags=Tags, error=e)
-                else:
-                    print_results_xlsx(data=img, sheetname='Images', region=region, OperationDone=OperationDone,
-                                       Tags=Tags)
-    _log("INFO: existing clean_images()")
+def _report_now(**row):
+    """
+    add a report row of a resource the plan leaves alone, it is journaled for --resume
+    :param row: print_results_xlsx arguments
+    """
+    journal.write('row', row=_row_record(row))
+    print_results_xlsx(**row)
 
 
-def clean_sg(dry_run=True):
+def _plan_ec2(plan, region, inventory, dry_run):
     """
-    Check each region for security groups with boto3, delete SG that are unused & untagged
-    :param dry_run: used for boto call, to avoid actually deleting anything
-    :return: None
+    add the stop/terminate of the EC2 instances of one region to the plan, based on the keep tag.
+    instances are stopped/terminated in batches of EC2_BATCH, then each instance has its own action
+    done when the region InstancePoller sees it stopped/terminated (volumes and SG depend on this)
+    :return: set of the instances to terminate
     """
-    _log(f"INFO: Cleaning SG")
-    headers = ["Region", "OwnerId", "SG Name", "SG Id", "VpcId", "FromPort",
-               "ToPort", "IpProtocol", "Source", "Instances", "Tags", "OperationDone"]
+    _log(f"INFO: Checking EC2 instances in region - {region}")
 
-    for region in regions:  # iterate over the region list and get the SG's
-        ec2 = boto3.client('ec2', region_name=region.strip())
-        response = ec2.describe_security_groups()
+    stop_list = []  # will store list of EC2 to be shutdown
+    terminate_list = []  # will store list of EC2 to be terminated
+    rows = {}  # instance id -> report row, written once the instance is stopped/terminated
 
-        _log(f"INFO: Checking SG in region - {region}")
+    for instance in inventory.instances.values():
 
-        security_group_record = {'Region': region}  # dict for the SG, will be send later to the report
+        # get tags and check what operation need to be done
+        if not instance.tags:
+            Tags = 'N/A'
+            operation = 'Terminate'
+        else:
+            Tags = instance.tags
+            if Tags.get('keep') == 'on':
+                operation = 'DoNothing'
+            elif Tags.get('keep') == 'off':
+                operation = 'Shutdown'
+            else:
+                operation = 'Terminate'
 
-        for sg in response['SecurityGroups']:  # iterate over all the SG in the current region and add data to dict
-            _log(f"INFO: Found security group")
-            _log(f"INFO: {sg}")
+        _log('DEBUG: instance: %s', instance)
+        row = dict(data=instance, sheetname='EC2', Tags=str(Tags), OperationDone=operation)
 
-            security_group_record['GroupName'] = sg['GroupName']
-            security_group_record['VpcId'] = sg.get('VpcId')
-            security_group_record['OwnerId'] = sg.get('OwnerId')
+        if operation == 'Shutdown':
+            stop_list.append(instance.id)
+            rows[instance.id] = row
+        elif operation == 'Terminate':
+            terminate_list.append(instance.id)
+            rows[instance.id] = row
+        else:
+            _report_now(**row)
 
-            security_group_record['Instances'] = ''
+    if not inventory.instances:
+        _log(f'WARNING: region {region}: No EC2 instances found')
+    else:
+        _log(f'INFO: region {region}: Found {len(inventory.instances)} EC2 instances')
 
-            # get instances so we have SG -> relation
-            instances_for_sg = ec2.describe_instances(
-                Filters=[{'Name': 'instance.group-id', 'Values': [sg.get('GroupId'), ]}, ])
-            instances_for_sg = [i for instance in instances_for_sg['Reservations'] for i in
-                                instance['Instances']]
-            instances_for_sg = [instance['InstanceId'] for instance in instances_for_sg]
+    for batch_key, instance_ids, operation in ((f"{region}:stop", stop_list, 'stop_instances'),
+                                               (f"{region}:terminate", terminate_list, 'terminate_instances')):
+        if not instance_ids:
+            continue
+        _add_action(plan, batch_key, region, 'EC2', operation, instance_ids, dry_run)
+        state = 'stopped' if operation == 'stop_instances' else 'terminated'
+        for instance_id in instance_ids:
+            _add_action(plan, f"{region}:{instance_id}", region, 'EC2', f'wait_{state}', instance_id, dry_run,
+                        [batch_key], [rows[instance_id]])
+    return set(terminate_list)
 
-            # set OperationDone to N/A, will be updated later if we delete
-            security_group_record['OperationDone'] = 'N/A'
-            security_group_record['GroupId'] = sg.get('GroupId')
 
-            delete_error = "N/A"
-            if not instances_for_sg:  # if no instances found, check for tag and update 'OperationDone'
-                security_group_record['Instances'] = 'N/A'
+def _plan_volumes(plan, region, inventory, dry_run, terminated):
+    """
+    add the deletion of the available volumes of one region to the plan, volumes attached only to
+    terminated instances are deleted after the termination (unless AWS deletes them with the instance)
+    :param terminated: instances terminated by the plan
+    """
+    _log(f'INFO: Cleaning available volumes for {region}')
+    for volume in inventory.volumes.values():
+        Tags = volume.tags
+        _log(
+            f"INFO: Found volume in {volume.zone}: {volume.id}({volume.state},"
+            f" {volume.iops} IOPS, {volume.type}) with Tag: {Tags}"
+        )
+        row = dict(data=volume, sheetname='Volumes', Tags=Tags, OperationDone='Terminate')
+        deps = []
+        if volume.state == 'in-use' and volume.attached_to and set(volume.attached_to) <= terminated:
+            if volume.delete_on_termination:
+                _report_now(**dict(row, OperationDone='DeleteOnTermination'))
+                continue
+            deps = [f"{region}:{instance_id}" for instance_id in volume.attached_to]
+        elif volume.state != 'available':
+            _report_now(**dict(row, OperationDone='Nothing'))
+            continue
+
+        _add_action(plan, f"{region}:{volume.id}", region, 'Volumes', 'delete_volume', volume.id, dry_run, deps,
+                    [row])
+
+
+def _plan_images(plan, region, inventory, dry_run):
+    """
+    add the deregistration of the AMIs of one region that are not tagged keep to the plan
+    :return: set of the AMIs to deregister
+    """
+    _log(f'INFO: Cleaning available images for {region}')
+    deregistered = set()
+    for img in inventory.images.values():
+        Tags = img.tags
+        row = dict(data=img, sheetname='Images', region=region, Tags=Tags)
+        if Tags and 'keep' in Tags or not rules['images'].matches(img):
+            _report_now(**row, OperationDone="Keep")
+            continue
+
+        deregistered.add(img.id)
+        _add_action(plan, f"{region}:{img.id}", region, 'Images', 'deregister_image', img.id, dry_run,
+                    rows=[dict(row, OperationDone="Deregister")])
+    if not inventory.images:
+        _log(f'WARNING: no images found for {region}')
+    return deregistered
+
+
+def _plan_snapshots(plan, region, inventory, dry_run, deregistered):
+    """
+    add the deletion of all the snapshots owned by the account in one region to the plan,
+    snapshots of deregistered AMIs are deleted after the AMI, the ones of kept AMIs are not deleted
+    :param deregistered: AMIs deregistered by the plan
+    """
+    _log(f'INFO: Cleaning all snapshots for {region}')
+    for snap in inventory.snapshots.values():
+        _log(f"INFO: Found {snap.id} for volume: {snap.volume_id}, size {snap.volume_size} GB")
+        row = dict(data=snap, sheetname='Snapshots', region=region)
+        images = inventory.images_of(snap.id)
+        kept_images = [image_id for image_id in images if image_id not in deregistered]
+        if kept_images:  # AWS refuses to delete it, the AMI was kept
+            _log(f"INFO: {snap.id} is used by {kept_images}, not deleting")
+            _report_now(**row, error=f"in use by {', '.join(kept_images)}")
+            continue
+
+        _add_action(plan, f"{region}:{snap.id}", region, 'Snapshots', 'delete_snapshot', snap.id, dry_run,
+                    [f"{region}:{image_id}" for image_id in images], [row])
+
+
+def _plan_sg(plan, region, inventory, dry_run, terminated):
+    """
+    add the deletion of the unused & untagged security groups of one region to the plan,
+    groups used only by terminated instances are deleted after the termination
+    :param terminated: instances terminated by the plan
+    """
+    _log(f"INFO: Checking SG in region - {region}")
 
-                sg_tag_no_delete = False
+    for sg in inventory.security_groups.values():  # iterate over all the SG in the current region
+        _log(f"INFO: Found security group {sg.id}")
+        _log('DEBUG: %s', sg)
 
-                if sg.get('Tags'):  # check if there are any tags at all
-                    for tag in sg.get('Tags'):  # check for the relevant tag
-                        if tag.get('Key') == 'keep':
-                            _log('INFO: Found no delete tag(keep)')
-                            sg_tag_no_delete = True  # don't delete
-                if not sg_tag_no_delete:
-                    security_group_record['OperationDone'] = 'Deleting'
-                    _log(f'INFO: removing sg - {sg.get("GroupId")}')
-                    try:
-                        ec2.delete_security_group(GroupId=sg.get('GroupId'), DryRun=dry_run)
-                    except ClientError as e:
-                        print(f"\tERROR: {str(e.response['Error'])}")
-                        delete_error = e
+        # dict for the SG, will be send later to the report
+        security_group_record = {'Region': region, 'GroupName': sg.name, 'VpcId': sg.vpc_id, 'OwnerId': sg.owner_id,
+                                 'GroupId': sg.id, 'OperationDone': 'N/A', 'Instances': 'N/A'}
 
-            else:
-                security_group_record['Instances'] = ', '.join(instances_for_sg)  # convert instance list to string
+        # instances/interfaces so we have SG -> relation
+        instances_for_sg = inventory.attachments_of(sg.id)
+        if instances_for_sg:
+            security_group_record['Instances'] = ', '.join(instances_for_sg)  # convert instance list to string
 
-            print_results_xlsx(data=security_group_record, sheetname='SG',
-                               OperationDone=security_group_record['OperationDone'], error=delete_error)
-        _log("INFO: Region END")
+        if sg.tags and 'keep' in sg.tags:
+            _log('INFO: Found no delete tag(keep)')
+        elif not set(instances_for_sg) <= terminated:  # used by instances/interfaces that stay
+            pass
+        else:
+            security_group_record['OperationDone'] = 'Deleting'
+            _add_action(plan, f"{region}:{sg.id}", region, 'SG', 'delete_security_group', sg.id, dry_run,
+                        [f"{region}:{instance_id}" for instance_id in instances_for_sg],
+                        [dict(data=security_group_record, sheetname='SG', OperationDone='Deleting', error="N/A")])
+            continue
 
+        _report_now(data=security_group_record, sheetname='SG', OperationDone=security_group_record['OperationDone'],
+                    error="N/A")
+    _log(f"INFO: Region END: {region}")
 
-def create_xlsx():
-    _log('INFO: Creating excel')
-    wb = Workbook()
 
-    ws_ec2 = wb.active
-    ws_ec2.title = 'EC2'
-    ws_ec2.append(
-        ("OperationDone", "InstanceId", "InstanceType", "AvailabilityZone", "PrivateIpAddress", "PublicDnsName",
-         "State", "SubnetId", "VpcId", "RootDeviceType", "Volumes", "SecurityGroups Name", "SecurityGroups",
-         "Tags"))
+def _plan_region(region, plan, operation, dry_run):
+    """
+    add the cleanup actions of one region to the plan
+    :param operation: 'storage', 'sg' or 'all'
+    """
+    inventory = get_inventory(region)
+    terminated = set()
+    if operation in ('storage', 'all'):
+        with metrics.phase('plan_ec2'):
+            terminated = _plan_ec2(plan, region, inventory, dry_run)
+        with metrics.phase('plan_volumes'):
+            _plan_volumes(plan, region, inventory, dry_run, terminated)
+        with metrics.phase('plan_images'):
+            deregistered = _plan_images(plan, region, inventory, dry_run)
+        with metrics.phase('plan_snapshots'):
+            _plan_snapshots(plan, region, inventory, dry_run, deregistered)
+    if operation in ('sg', 'all'):
+        with metrics.phase('plan_sg'):
+            _plan_sg(plan, region, inventory, dry_run, terminated)
+    if from_cache:
+        _log(f"INFO: {region}: fetched from AWS (missing or stale in {store.file_name}) - "
+             f"{inventory.refreshed or 'none'}")
+
+
+def _report_node(node):
+    """
+    add the report rows of a plan action once it is done
+    :param node: deletionPlan.PlanNode
+    """
+    error = node.error
+    journal.write('done', key=node.key, error=None if error is None else str(error), result=node.result)
+    if _failed(node):
+        _log(f'ERROR: {node.key}: {error}')
+    elif error is not None:  # DryRun
+        _log(f'INFO: {node.key}: {error}')
+
+    for row in node.rows:
+        if node.kind == 'EC2':  # EC2 errors have their own row
+            row = dict(row, done_after=node.result)
+        elif error is not None:
+            row = dict(row, error=error)
+        print_results_xlsx(wave=node.wave, **row)
+
+    if node.kind == 'EC2' and error is not None:
+        if node.key.endswith((':stop', ':terminate')):
+            operation = 'ERROR-Shutdown' if node.key.endswith(':stop') else 'ERROR-Terminate'
+        elif isinstance(error, TimeoutError):
+            operation = 'ERROR-waitShutdown' if node.rows[0]['OperationDone'] == 'Shutdown' else 'ERROR-waitTerminate'
+        else:  # skipped, the stop/terminate call failed and has its own row
+            return
+        print_results_xlsx(data=str(node.resource_id), sheetname='EC2', OperationDone=operation, error=str(error),
+                           wave=node.wave)
+
+
+def _resume_plan(plan, records, dry_run):
+    """
+    rebuild the plan of a previous run from its journal instead of scanning the regions again,
+    the rows reported when planning are copied to the new report
+    :param records: runJournal.read_journal records
+    """
+    for record in records:
+        if record['event'] == 'row':
+            _report_now(**_row_from_record(record['row']))
+        elif record['event'] == 'planned':
+            _add_action(plan, record['key'], record['region'], record['kind'], record['operation'],
+                        record['resource_id'], dry_run, record['deps'],
+                        [_row_from_record(row) for row in record['rows']])
 
-    ws_volumes = wb.create_sheet()
-    ws_volumes.title = 'Volumes'
-    ws_volumes.append(
-        ("OperationDone", "VolumeId", "AvailabilityZone", "State", "Iops", "VolumeType", "Tags", "Errors"))
 
-    ws_snapshots = wb.create_sheet()
-    ws_snapshots.title = 'Snapshots'
-    ws_snapshots.append(("SnapshotID(deleted)", "VolumeId", "Region", "Errors"))
+def clean(operation, dry_run=True, records=None):
+    """
+    plan the cleanup of all the regions then run it: instances before their volumes, AMIs before
+    their snapshots and instances before their SG. independent actions of all the regions run in parallel
+    :param operation: 'storage' (EC2/Images/Snapshots/Volume), 'sg' (security groups) or 'all'
+    :param dry_run: for BOTO3 call
+    :param records: journal records of the run to resume, None to scan the regions
+    """
+    journal.write('run', operation=operation, dry_run=dry_run, from_cache=from_cache)
+    plan = DeletionPlan()
+    if records:
+        _log(f"INFO: Resuming cleanup - {operation}, {len(completed)} actions already done")
+        _resume_plan(plan, records, dry_run)
+    else:
+        _log(f"INFO: Planning cleanup - {operation}")
+        run_per_region(_plan_region, regions, workers, _log, plan, operation, dry_run)
+    journal.write('plan_complete', actions=len(plan.nodes))  # --resume only trusts a plan with this record
+    journal.sync()
 
-    ws_images = wb.create_sheet()
-    ws_images.title = 'Images'
-    ws_images.append(
-        ("OperationDone", "ImageId", "Name", "Region", "OwnerId", "ImageType", "CreationDate", "Tags", "Errors"))
+    for line in plan.describe():  # the plan to review in dry run
+        _log(('INFO: ' if dry_run else 'DEBUG: ') + 'plan - %s', line)
 
-    ws_images = wb.create_sheet()
-    ws_images.title = 'SG'
-    ws_images.append(
-        ("OperationDone", "SG Id", "SG Name", "OwnerId", "Region", "VpcId", "Instances", "Errors"))
+    if not dry_run:  # --from_cache must not plan the resources deleted by this run again
+        changed = {(node.region, kind) for node in plan.nodes.values() for kind in STORE_KINDS[node.kind]}
+        store.expire(changed)
+        _log(f"DEBUG: expired in {store.file_name} - %s", sorted(changed))
 
-    wb.save(xlsx_name)
+    _log(f"INFO: Running {len(plan.nodes)} cleanup actions")
+    with metrics.phase('run_plan'):
+        plan.run(workers, _report_node, _failed)
+    for line in limiter.summary():
+        _log(f"INFO: API {line}")
+    _log("INFO: existing clean()")
 
 
-def print_results_xlsx(**kwargs):
-    wb = load_workbook(xlsx_name)
-    ws = wb[kwargs['sheetname']]
+class XlsxReport:
+    """
+    xlsx report opened once in write-only (streaming) mode, rows are appended as they come
+    and the workbook is saved a single time when close() is called
+    """
+    sheets = (
+        ('EC2', ("OperationDone", "InstanceId", "InstanceType", "AvailabilityZone", "PrivateIpAddress",
+                 "PublicDnsName", "State", "SubnetId", "VpcId", "RootDeviceType", "Volumes", "SecurityGroups Name",
+                 "SecurityGroups", "Tags", "DoneAfter(s)", "Wave")),
+        ('Volumes', ("OperationDone", "VolumeId", "AvailabilityZone", "State", "Iops", "VolumeType", "Tags",
+                     "Errors", "Wave")),
+        ('Snapshots', ("SnapshotID(deleted)", "VolumeId", "Region", "Errors", "Wave")),
+        ('Images', ("OperationDone", "ImageId", "Name", "Region", "OwnerId", "ImageType", "CreationDate", "Tags",
+                    "Errors", "Wave")),
+        ('SG', ("OperationDone", "SG Id", "SG Name", "OwnerId", "Region", "VpcId", "Instances", "Errors", "Wave")),
+    )
+
+    def __init__(self, file_name):
+        from openpyxl import Workbook  # slow to import, only when a report is written
+        self.file_name = file_name
+        self.closed = False
+        self._lock = Lock()  # regions are cleaned in worker threads, only one may write at a time
+        self._wb = Workbook(write_only=True)
+        self._ws = {}
+        self._ws_headers = dict(self.sheets)
+        for title, headers in self.sheets:
+            ws = self._wb.create_sheet(title)
+            ws.append(headers)
+            self._ws[title] = ws
+
+    def append(self, sheetname, row, wave=None):
+        """
+        add a row to one of the report sheets
+        :param sheetname: one of the sheet names in XlsxReport.sheets
+        :param row: tuple matching the sheet headers, without the Wave column
+        :param wave: wave of the cleanup plan the resource was deleted in, None if it was not deleted
+        """
+        columns = len(self._ws_headers[sheetname]) - 1
+        row = tuple(row) + (None,) * (columns - len(row)) + (wave,)
+        with self._lock:
+            self._ws[sheetname].append(row)
+
+    def close(self):
+        """
+        save the workbook to disk, only the first call does anything
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._wb.save(self.file_name)
+        _log(f'INFO: Report saved - {self.file_name}')
+
+
+def create_xlsx():
+    _log('INFO: Creating excel')
+    return XlsxReport(xlsx_name)
+
 
+def print_results_xlsx(**kwargs):
+    """
+    add a row to the report, see XlsxReport.sheets
+    :param kwargs: sheetname, data (the resource record), OperationDone, Tags, region, error and wave
+    """
     error = kwargs.get('error')
     if kwargs['sheetname'] == 'Volumes':
+        volume = kwargs['data']
         row = (
-            kwargs['OperationDone'], kwargs['data']['VolumeId'], kwargs['data']['AvailabilityZone'],
-            kwargs['data']['State'], kwargs['data']['Iops'], kwargs['data']['VolumeType'],
+            kwargs['OperationDone'], volume.id, volume.zone, volume.state, volume.iops, volume.type,
             str(kwargs['Tags']), str(error)
         )
-        ws.append(row)
-        wb.save(xlsx_name)
+        report.append('Volumes', row, kwargs.get('wave'))
 
     elif kwargs['sheetname'] == 'Snapshots':
-        row = (kwargs['data']['SnapshotId'], kwargs['data']['VolumeId'], kwargs['region'], str(error))
-        ws.append(row)
-        wb.save(xlsx_name)
+        row = (kwargs['data'].id, kwargs['data'].volume_id, kwargs['region'], str(error))
+        report.append('Snapshots', row, kwargs.get('wave'))
 
     elif kwargs['sheetname'] == 'Images':
-        row = (kwargs['OperationDone'], kwargs['data']["ImageId"], kwargs['data']["Name"], kwargs['region'],
-               kwargs['data']["OwnerId"], kwargs['data']["ImageType"], kwargs['data']["CreationDate"],
+        img = kwargs['data']
+        row = (kwargs['OperationDone'], img.id, img.name, kwargs['region'], img.owner_id, img.type, img.creation_date,
                str(kwargs["Tags"]), str(error))
-        ws.append(row)
-        wb.save(xlsx_name)
+        report.append('Images', row, kwargs.get('wave'))
 
     elif kwargs['sheetname'] == 'EC2' and error == None:
 
-        if not kwargs['data']['PublicDnsName']: kwargs['data']['PublicDnsName'] = 'N/A'
+        instance = kwargs['data']
 
         volume_list = ''
-        for volume in kwargs['data']['BlockDeviceMappings']:
-            volume_list += f"{(volume['Ebs']['VolumeId'])}({volume['Ebs']['Status']}),  "
+        for volume_id, status in instance.volumes:
+            volume_list += f"{volume_id}({status}),  "
 
         sg_list_name = ''
         sg_list_id = ''
-        for sg in kwargs['data']['SecurityGroups']:
-            sg_list_name += f"{sg['GroupName']},  "
-            sg_list_id += f"{sg['GroupId']},  "
-
-        row = (kwargs['OperationDone'], kwargs['data']['InstanceId'], kwargs['data']['InstanceType'],
-               kwargs['data']['Placement']['AvailabilityZone'],
-               kwargs['data'].get('PrivateIpAddress'), kwargs['data']['PublicDnsName'], kwargs['data']['State']['Name'],
-               kwargs['data'].get('SubnetId'),
-               kwargs['data'].get('VpcId'), kwargs['data']['RootDeviceType'], volume_list, sg_list_name, sg_list_id,
-               kwargs['Tags'])
-        ws.append(row)
-        wb.save(xlsx_name)
+        for group_id, group_name in instance.security_groups:
+            sg_list_name += f"{group_name},  "
+            sg_list_id += f"{group_id},  "
+
+        row = (kwargs['OperationDone'], instance.id, instance.type, instance.zone, instance.private_ip,
+               instance.public_dns or 'N/A', instance.state, instance.subnet_id, instance.vpc_id,
+               instance.root_device_type, volume_list, sg_list_name, sg_list_id, kwargs['Tags'],
+               kwargs.get('done_after'))
+        report.append('EC2', row, kwargs.get('wave'))
     elif kwargs['sheetname'] == 'EC2':
-        ws.append((kwargs['OperationDone'], kwargs['data'], error))
-        wb.save(xlsx_name)
+        report.append('EC2', (kwargs['OperationDone'], kwargs['data'], error), kwargs.get('wave'))
 
     elif kwargs['sheetname'] == 'SG':
 
@@ -383,24 +562,32 @@ def print_results_xlsx(**kwargs):
         kwargs['data']['Region'], kwargs['data']["VpcId"], kwargs['data']["Instances"],
         str(error))
 
-        ws.append(row)
-        wb.save(xlsx_name)
+        report.append('SG', row, kwargs.get('wave'))
 
 
-def _log(line):
-    console = True
+logger = setup_logging('cleanResources')
+inventories = {}  # region -> RegionInventory, see get_inventory
+_inventories_lock = Lock()
+pollers = {}  # region -> InstancePoller, see get_poller
+completed = {}  # plan key -> result of the actions done by the resumed run, see --resume
+rules = get_rules()  # resources selected for the cleanup, see --older_than
+store = None  # inventoryStore.InventoryStore the inventories are saved to, see --inventory_file
+from_cache = False  # plan from the store, see --from_cache
+limiter = ApiLimiter()  # rate of the delete/terminate calls, see --api_rate
 
-    if Logfile:
-        with open(log_name, "a") as file:
-            file.write(str(line) + '\n')
-    if console:
-        print(line)
+
+def _log(line, *args):
+    """
+    log to console and/or log file, see awsCommon.log_line
+    :param line: line to be printed to log, starting with the level, e.g. 'INFO: '
+    :param args: objects formatted into line with %s only if the level is logged
+    """
+    log_line(logger, line, *args)
 
 
 if __name__ == '__main__':
 
     dryrun = False
-    Logfile = False
 
     parser = argparse.ArgumentParser(description='Run cleanup as config in the config.txt file')
     parser.add_argument('--operation', '-o', type=str,
@@ -409,42 +596,117 @@ if __name__ == '__main__':
                         help='Run in dry run mode, wont delete anything if set to True')
     parser.add_argument('--log', metavar='Bool', type=str,
                         help='Will create logs file for the CLI Operations')
+    parser.add_argument('--log_level', type=str, choices=LOG_LEVELS, default='INFO',
+                        help='DEBUG also logs the raw AWS responses (default INFO)')
+    parser.add_argument('--log_json', metavar='Bool', type=str,
+                        help='write the log file as json lines')
+    parser.add_argument('--workers', '-w', type=int, default=4,
+                        help='number of regions planned and cleanup actions run at the same time (default 4)')
+    parser.add_argument('--older_than', type=float,
+                        help='only clean EC2, volumes, snapshots and images created more than this number of days ago')
+    parser.add_argument('--resume', type=str, metavar='RUN_ID',
+                        help='finish a killed/crashed run from its journal (clean_journal_<RUN_ID>.jsonl) without '
+                             'scanning again, the actions it completed are not run again. a dry run (or --from_cache '
+                             'run) is resumed as a dry run unless --dryrun False is given, and its actions are all '
+                             'run again. a run killed before the end of its plan deleted nothing and is planned again')
+    parser.add_argument('--metrics', metavar='Bool', type=str,
+                        help='write the AWS calls and phases metrics to a json file (the summary is always logged)')
+    parser.add_argument('--profile', metavar='Bool', type=str,
+                        help='run with cProfile and save the stats to a .prof file')
+    parser.add_argument('--share', '-sh', type=str, choices=('s3', 'email'),
+                        help='share the report and log file via s3 or email, gzip compressed')
+    parser.add_argument('--bucket_name', '-b', type=str,
+                        help='Bucket name to upload to, if --share=s3 selected, with --share=email the files too big '
+                             'to attach are uploaded to it and linked')
+    parser.add_argument('--ses_sender', '-sess', type=str,
+                        help='email SES details, if --share=email selected')
+    parser.add_argument('--ses_recipient', '-sesr', type=str,
+                        help='email SES details, if --share=email selected')
+    parser.add_argument('--ses_region', type=str, default=SES_REGION,
+                        help=f'SES region, if --share=email selected (default {SES_REGION})')
+    parser.add_argument('--inventory_file', type=str, default='Inventory.db',
+                        help='sqlite store the scanned resources are saved to, for --from_cache (default Inventory.db)')
+    parser.add_argument('--from_cache', metavar='Bool', type=str,
+                        help='dry run planned from the --inventory_file store without scanning, only the region '
+                             'resource types missing in it or stale are fetched again, the plan actions are reported '
+                             'but not sent to AWS')
+    parser.add_argument('--api_rate', type=float, default=API_RATE,
+                        help=f'max delete/terminate calls per second for each region and API action, throttled calls'
+                             f' are retried with backoff (default {API_RATE})')
 
     args = parser.parse_args()
 
-    log_name = strftime('clean_log_' + "%Y-%b-%d_%H-%M-%S.log")
-    xlsx_name = strftime('ServiceCleaner_' + "%Y-%b-%d_%H-%M-%S.xlsx")
-    regions = get_config_regions()
+    log_name = strftime('clean_log_' + "%Y-%b-%d_%H-%M-%S" + ('.jsonl' if args.log_json == 'True' else '.log'))
+    logger = setup_logging('cleanResources', log_name if args.log == 'True' else None, level=args.log_level,
+                           json_lines=args.log_json == 'True')
+
+    records = None
+    if args.resume:  # the operation, the dry run and the plan come from the journal of the resumed run
+        records = read_journal(f'clean_journal_{args.resume}.jsonl')
+        resumed = next((record for record in records if record['event'] == 'run'), {})
+        args.operation = resumed.get('operation')
+        if args.dryrun is None:
+            args.dryrun = str(resumed.get('dry_run', True))
+        if not any(record['event'] == 'plan_complete' for record in records):  # killed before running anything
+            _log(f"INFO: the plan of {args.resume} was not finished, nothing was deleted, the regions are scanned")
+            records = None
+        elif resumed.get('dry_run', True) or resumed.get('from_cache'):  # its actions deleted nothing
+            _log(f"INFO: {args.resume} was a dry run, all its actions are run again"
+                 + ('' if args.dryrun == 'True' else ' for real (--dryrun False)'))
+        else:
+            completed.update((record['key'], record['result']) for record in records
+                             if record['event'] == 'done' and record['error'] is None)
 
-    if (args.log == 'True'):
-        Logfile = True
+    if args.operation not in ('storage', 'sg', 'all'):  # checked before anything slow (AWS clients, boto3 import)
+        _log(f"INFO: provided argument is incorrect:\n  operation={args.operation}")
+        sys.exit(1)
+    if args.from_cache == 'True' and args.resume:
+        _log('ERROR: --from_cache and --resume can not be used together')
+        sys.exit(1)
+    if args.share == 's3' and not args.bucket_name:
+        _log('ERROR: --bucket_name is needed with --share s3')
+        sys.exit(1)
+    if args.share == 'email' and not (args.ses_sender and args.ses_recipient):
+        _log('ERROR: --ses_sender and --ses_recipient are needed with --share email')
+        sys.exit(1)
+
+    run_id = strftime("%Y-%b-%d_%H-%M-%S")
+    instrument()
+    profilers = start_profile() if args.profile == 'True' else None
+    from_cache = args.from_cache == 'True'
+    xlsx_name = f"ServiceCleaner_{run_id}{'_from_cache' if from_cache else ''}.xlsx"
+    regions = get_config_regions()
+    workers = args.workers
+    clients.configure(workers)
+    limiter = ApiLimiter(args.api_rate)
+    rules = get_rules(args.older_than)
+    account = get_config_account()
 
-    if (args.dryrun == 'True'):
+    if (args.dryrun == 'True') or from_cache:
         dryrun = True
-
-    if (args.operation == 'storage'):
-        _log(f"INFO: Cleaning storage")
-        create_xlsx()
-        clean_ec2(dryrun)
-        clean_volumes(dryrun)
-        clean_images(dryrun)
-        clean_snapshot(dryrun)
-
-
-    elif (args.operation == 'sg'):
-        _log(f"INFO: Cleaning Security Groups")
-        create_xlsx()
-        clean_sg(dryrun)
-
-
-    elif (args.operation == 'all'):
-        _log(f"INFO: Cleaning Storage and SG")
-        create_xlsx()
-        clean_ec2(dryrun)
-        clean_volumes(dryrun)
-        clean_images(dryrun)
-        clean_snapshot(dryrun)
-        clean_sg(dryrun)
-
-    else:
-        _log(f"INFO: provided argument is incorrect:\n  operation={args.operation}")
+    store = InventoryStore(args.inventory_file)
+
+    report = create_xlsx()
+    journal = RunJournal(f'clean_journal_{run_id}.jsonl')
+    _log(f"INFO: run id {run_id}, resume it with --resume {run_id} if it stops before the end")
+    try:
+        if (args.operation == 'storage'):
+            _log(f"INFO: Cleaning storage")
+        elif (args.operation == 'sg'):
+            _log(f"INFO: Cleaning Security Groups")
+        elif (args.operation == 'all'):
+            _log(f"INFO: Cleaning Storage and SG")
+        clean(args.operation, dryrun, records)
+    finally:  # save the report once, also when a cleaning pass crashed
+        journal.close()
+        report.close()
+        store.close()
+        report_metrics(_log, f'clean_metrics_{run_id}.json' if args.metrics == 'True' else None, profilers,
+                       f'clean_profile_{run_id}.prof')
+
+    if args.share:
+        close_logging(logger)  # write the buffered log lines before the log is shared
+        logger = setup_logging('cleanResources', level=args.log_level)  # the log file is closed, console only
+        share_reports([xlsx_name, log_name if args.log == 'True' else None], args.share, _log, args.bucket_name,
+                      args.ses_sender, args.ses_recipient, "Cleanup report", "Attached cleanup report",
+                      args.ses_region)
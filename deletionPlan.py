@@ -0,0 +1,121 @@
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from threading import Lock
+
+
+class PlanNode:
+    """
+    one cleanup action of the plan, e.g. deleting a volume
+    """
+    __slots__ = ('key', 'region', 'kind', 'resource_id', 'action', 'deps', 'dependents', 'wave', 'error', 'result',
+                 'rows')
+
+    def __init__(self, key, region, kind, resource_id, action, deps, rows):
+        self.key = key
+        self.region = region
+        self.kind = kind
+        self.resource_id = resource_id
+        self.action = action
+        self.deps = deps
+        self.dependents = []
+        self.wave = 0
+        self.error = None
+        self.result = None
+        self.rows = rows
+
+
+class DeletionPlan:
+    """
+    dependency graph (DAG) of the cleanup actions of all the regions, e.g. the volumes of an instance
+    depend on the instance termination. run() starts every action as soon as all the actions it
+    depends on are done, the wave of an action is its depth in the graph (0 = no dependencies)
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self._lock = Lock()  # regions are planned in worker threads
+
+    def add(self, key, region, kind, resource_id, action, deps=(), rows=()):
+        """
+        add an action to the plan
+        :param key: unique key of the action, used by other actions to depend on it
+        :param region: region of the resource
+        :param kind: resource type, e.g. 'Volumes'
+        :param resource_id: resource id, or description of the resources for batch actions
+        :param action: function without arguments doing the action, raise an exception on failure.
+                       it can return a Future when the action finishes outside of the pool (e.g. polled)
+        :param deps: keys of the actions that must be done before this one, they must be added first
+        :param rows: anything the caller need when the action is done (see run on_done)
+        """
+        with self._lock:
+            node = PlanNode(key, region, kind, resource_id, action, [self.nodes[dep] for dep in deps], list(rows))
+            for dep in node.deps:
+                dep.dependents.append(node)
+                node.wave = max(node.wave, dep.wave + 1)
+            self.nodes[key] = node
+        return node
+
+    def waves(self):
+        """
+        :return: list of the waves, each one a list of nodes
+        """
+        waves = []
+        for node in self.nodes.values():
+            while len(waves) <= node.wave:
+                waves.append([])
+            waves[node.wave].append(node)
+        return waves
+
+    def describe(self):
+        """
+        :return: the plan as text lines, for review in dry run
+        """
+        lines = []
+        for wave, nodes in enumerate(self.waves()):
+            lines.append(f"wave {wave}: {len(nodes)} actions")
+            for node in nodes:
+                after = f" after {', '.join(dep.key for dep in node.deps)}" if node.deps else ''
+                lines.append(f"  {node.key}{after}")
+        return lines
+
+    def run(self, workers, on_done, failed):
+        """
+        run the actions in a thread pool, each one when its dependencies are done.
+        when a dependency failed the action is not run, node.error is set to the failed dependency
+        :param workers: max number of actions running at the same time
+        :param on_done: called with each node after its action (or its skip), in the calling thread.
+                        node.result is the action return value
+        :param failed: function(node) -> True if the action of node failed and its dependents must be skipped
+        """
+        remaining = {node.key: len(node.deps) for node in self.nodes.values()}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            running = {}
+
+            def start(node):
+                running[executor.submit(node.action)] = node
+
+            def done(node):
+                on_done(node)
+                for dependent in node.dependents:
+                    remaining[dependent.key] -= 1
+                    if dependent.error is None and failed(node):
+                        dependent.error = f"skipped, {node.key} failed: {node.error}"
+                    if remaining[dependent.key] == 0:
+                        if dependent.error is None:
+                            start(dependent)
+                        else:
+                            done(dependent)
+
+            for node in self.nodes.values():
+                if not node.deps:
+                    start(node)
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    node.error = future.exception()
+                    if node.error is None and isinstance(future.result(), Future):  # finishes outside the pool
+                        running[future.result()] = node
+                        continue
+                    if node.error is None:
+                        node.result = future.result()
+                    done(node)
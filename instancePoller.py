@@ -0,0 +1,93 @@
+from concurrent.futures import Future
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from awsCommon import paginate
+
+POLL_DELAY = 5  # seconds between two describe_instances of the watched instances
+POLL_TIMEOUT = 300  # seconds an instance can take to reach its state
+FILTER_VALUES = 200  # max values of an EC2 filter
+
+
+class InstancePoller:
+    """
+    tracks EC2 instances of one region until they reach a state (terminated, stopped...) in a
+    background thread. all the watched instances are checked together, with one describe_instances
+    per POLL_DELAY, instead of a blocking waiter for each stop/terminate call
+    """
+
+    def __init__(self, ec2, delay=POLL_DELAY, timeout=POLL_TIMEOUT):
+        """
+        :param ec2: boto3 ec2 client of the region
+        :param delay: seconds between two checks
+        :param timeout: seconds after which an instance that is not in its state fails
+        """
+        self.ec2 = ec2
+        self.delay = delay
+        self.timeout = timeout
+        self._pending = {}  # instance id -> (state, start time, future)
+        self._lock = Lock()
+        self._thread = None
+
+    def watch(self, instance_id, state='terminated'):
+        """
+        start tracking an instance, the poller thread runs while there are instances to track
+        :param instance_id: instance id, after the stop/terminate call
+        :param state: instance state to wait for
+        :return: Future with the seconds it took the instance to reach the state, or TimeoutError
+        """
+        future = Future()
+        with self._lock:
+            self._pending[instance_id] = (state, perf_counter(), future)
+            if self._thread is None:
+                self._thread = Thread(target=self._poll, name=f'poller-{self.ec2.meta.region_name}', daemon=True)
+                self._thread.start()
+        return future
+
+    def _states(self, instance_ids):
+        """
+        :return: dict of instance id -> state name, instances terminated long ago are not returned by AWS
+        """
+        states = {}
+        for i in range(0, len(instance_ids), FILTER_VALUES):
+            filters = [{'Name': 'instance-id', 'Values': instance_ids[i:i + FILTER_VALUES]}]
+            for instance in paginate(self.ec2, 'describe_instances', 'Reservations[].Instances[]', Filters=filters):
+                states[instance['InstanceId']] = instance['State']['Name']
+        return states
+
+    def _poll(self):
+        """
+        poller thread, checks the watched instances until there are none left. when describe_instances
+        fails the timeouts are still checked, and an unexpected error fails all the watched instances
+        """
+        from botocore.exceptions import BotoCoreError, ClientError
+        try:
+            while True:
+                sleep(self.delay)
+                with self._lock:
+                    pending = dict(self._pending)
+                try:
+                    states, error = self._states(list(pending)), None
+                except (BotoCoreError, ClientError) as e:  # e.g. throttled or no connection, check again next round
+                    states, error = None, e
+
+                now = perf_counter()
+                with self._lock:
+                    for instance_id, (state, start, future) in pending.items():
+                        current = f'unknown ({error})' if error else states.get(instance_id, 'terminated')
+                        if current == state:
+                            future.set_result(round(now - start, 1))
+                        elif now - start > self.timeout:
+                            future.set_exception(TimeoutError(f"{instance_id} is still {current} after "
+                                                              f"{self.timeout}s, expected {state}"))
+                        else:
+                            continue
+                        del self._pending[instance_id]
+                    if not self._pending:
+                        self._thread = None
+                        return
+        except Exception as e:  # the actions waiting on the futures would wait forever
+            with self._lock:
+                for state, start, future in self._pending.values():
+                    future.set_exception(e)
+                self._pending.clear()
+                self._thread = None
@@ -0,0 +1,85 @@
+import json
+import sqlite3
+from threading import Lock
+from time import time
+
+STORE_VERSION = 2  # schema version, a store of another version is emptied
+DEFAULT_TTL = 60 * 60  # seconds a stored resource type stays fresh when it has no STORE_TTL
+STORE_TTL = {'instances': 60 * 60, 'volumes': 60 * 60, 'snapshots': 6 * 60 * 60, 'images': 24 * 60 * 60,
+             'security_groups': 6 * 60 * 60, 'sg_attachments': 60 * 60, 'report_security_groups': 6 * 60 * 60,
+             'report_sg_attachments': 60 * 60}  # resource type -> seconds, types that change often expire first
+
+
+class InventoryStore:
+    """
+    sqlite file with the resources fetched by the describe_* passes of the AWS scripts, so reports and
+    dry run plans can be made from it (--from_cache) instead of scanning the regions again.
+    each region and resource type is saved as a whole with the time and the selection rule it was
+    fetched with, a stale type (see STORE_TTL) is fetched again alone
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._lock = Lock()  # regions are fetched in worker threads
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != STORE_VERSION:  # everything is fetched again
+            self._db.executescript('DROP TABLE IF EXISTS resources; DROP TABLE IF EXISTS resource_tags;'
+                                   f'DROP TABLE IF EXISTS refreshes; PRAGMA user_version = {STORE_VERSION};')
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS resources (region TEXT, kind TEXT, id TEXT, record TEXT, '
+            'PRIMARY KEY (region, kind, id));'
+            'CREATE TABLE IF NOT EXISTS refreshes (region TEXT, kind TEXT, rule TEXT, fetched_at REAL, '
+            'PRIMARY KEY (region, kind));')
+
+    def save(self, region, kind, resources, rule=''):
+        """
+        replace the stored resources of one type of a region by the ones just fetched
+        :param region: region name
+        :param kind: resource type, e.g. 'volumes'
+        :param resources: list of (id, json serializable record)
+        :param rule: selection the resources were fetched with (e.g. the describe_* Filters as json),
+                     load() only returns them for the same selection
+        """
+        with self._lock, self._db:  # one transaction, a crash keeps the previous refresh
+            self._db.execute('DELETE FROM resources WHERE region = ? AND kind = ?', (region, kind))
+            self._db.executemany('INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?)',
+                                 [(region, kind, resource_id, json.dumps(record, default=str))
+                                  for resource_id, record in resources])
+            self._db.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)', (region, kind, rule, time()))
+
+    def age(self, region, kind, rule=''):
+        """
+        :return: seconds since the resources of the type were saved, None if they never were (or with another rule)
+        """
+        with self._lock:
+            refresh = self._db.execute('SELECT rule, fetched_at FROM refreshes WHERE region = ? AND kind = ?',
+                                       (region, kind)).fetchone()
+        if refresh is None or refresh[0] != rule:
+            return None
+        return time() - refresh[1]
+
+    def expire(self, region_kinds):
+        """
+        mark resource types as stale, e.g. before a cleanup deletes some of them, they are fetched again
+        by the next run instead of being read from the store
+        :param region_kinds: (region, resource type) pairs
+        """
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM refreshes WHERE region = ? AND kind = ?', list(region_kinds))
+
+    def load(self, region, kind, rule='', ttl=None):
+        """
+        :param ttl: max age in seconds, STORE_TTL of the type when None
+        :return: list of the stored records of the type in the region, None when they must be fetched
+                 again (never saved, stale or saved with another rule)
+        """
+        age = self.age(region, kind, rule)
+        if age is None or age > (STORE_TTL.get(kind, DEFAULT_TTL) if ttl is None else ttl):
+            return None
+        with self._lock:
+            return [json.loads(record) for record, in self._db.execute(
+                'SELECT record FROM resources WHERE region = ? AND kind = ? ORDER BY rowid', (region, kind))]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
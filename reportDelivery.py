@@ -0,0 +1,222 @@
+import io
+import os
+import shutil
+import tempfile
+import zlib
+from awsCommon import clients
+
+SES_REGION = 'us-east-1'
+SES_MAX_ATTACHMENTS = 7 * 2 ** 20  # bytes, SES raw messages are limited to 10 MB after base64 (+33%)
+PRESIGN_SECONDS = 7 * 24 * 60 * 60  # max life of a SigV4 pre-signed link
+S3_CHUNK = 16 * 2 ** 20  # multipart upload part size
+S3_CONCURRENCY = 8  # parts uploaded at the same time
+READ_CHUNK = 2 ** 20
+COMPRESSED_SUFFIXES = ('.gz', '.xlsx', '.parquet', '.zip')  # not compressed again
+
+
+class GzipReader(io.RawIOBase):
+    """
+    read-only file object returning the gzip compression of a file, compressed chunk by chunk as it
+    is read, so a file can be uploaded compressed without a compressed copy on disk or in memory
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+        self._buffer = bytearray()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self._buffer) < len(buffer) and self._compressor:
+            data = self._file.read(READ_CHUNK)
+            if data:
+                self._buffer += self._compressor.compress(data)
+            else:
+                self._buffer += self._compressor.flush()
+                self._compressor = None
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        del self._buffer[:size]
+        return size
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class _Borrowed(io.RawIOBase):
+    """
+    read-only view of a file object that leaves it open when closed, the uploads close what they send
+    """
+
+    def __init__(self, file):
+        self._file = file
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _delivered_name(path, compress):
+    """
+    :return: (file object to send, file name) of a report, gzip compressed on the fly unless it already is
+    """
+    name = os.path.basename(path)
+    if compress and not name.endswith(COMPRESSED_SUFFIXES):
+        return GzipReader(path), name + '.gz'
+    return open(path, 'rb'), name
+
+
+def _transfer(file, bucket, key, log, path, region=None):
+    """
+    multipart upload of a file object, see upload_s3
+    :param path: file the object comes from, for the logs
+    :param region: region of the bucket, None for the default one
+    :return: the object key, None if the upload failed
+    """
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+    config = TransferConfig(multipart_threshold=S3_CHUNK, multipart_chunksize=S3_CHUNK,
+                            max_concurrency=S3_CONCURRENCY, use_threads=True)
+    try:
+        clients.get('s3', region).upload_fileobj(file, bucket, key, Config=config)
+    except ClientError as e:
+        log(f"ERROR: upload of {path} to s3://{bucket}/{key} failed: {e}")
+        return None
+    log(f"INFO: {path} uploaded to s3://{bucket}/{key}")
+    return key
+
+
+def upload_s3(path, bucket, log, compress=True, prefix=''):
+    """
+    upload a report to S3, compressed while it is read and sent in parallel multipart chunks
+    :param path: file to upload
+    :param bucket: bucket name
+    :param log: log function of the calling script
+    :param compress: gzip the file (not for files that are already compressed)
+    :param prefix: key prefix, e.g. 'reports/'
+    :return: the object key, None if the upload failed
+    """
+    file, name = _delivered_name(path, compress)
+    with file:
+        return _transfer(file, bucket, prefix + name, log, path)
+
+
+def _bucket_region(bucket, log):
+    """
+    :return: region of the bucket, pre-signed links must be signed for it. None (default region) if unknown
+    """
+    from botocore.exceptions import ClientError
+    try:
+        location = clients.get('s3').get_bucket_location(Bucket=bucket)['LocationConstraint']
+    except ClientError as e:
+        log(f"WARNING: region of s3://{bucket} unknown, the links are signed for the default region: {e}")
+        return None
+    return {None: 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)  # legacy location names
+
+
+def send_email(sender, recipient, subject, body, paths, log, bucket=None, ses_region=SES_REGION, compress=True):
+    """
+    email reports with SES, compressed. when the attachments are too big for SES they are uploaded
+    to bucket and the email has pre-signed links to them instead, a report that can't be uploaded
+    is attached if it fits
+    :param paths: files to send
+    :param log: log function of the calling script
+    :param bucket: bucket for the reports too big to attach, None to send them anyway (SES may refuse)
+    :param ses_region: SES region
+    :param compress: gzip the files (not the ones that are already compressed)
+    :return: True if the email was sent
+    """
+    from botocore.exceptions import ClientError
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    attachments = []  # (path, name, spooled file, size), spilled to disk above the SES limit
+    try:
+        for path in paths:
+            file, name = _delivered_name(path, compress)
+            spooled = tempfile.SpooledTemporaryFile(max_size=SES_MAX_ATTACHMENTS)
+            with file:
+                shutil.copyfileobj(file, spooled, READ_CHUNK)
+            attachments.append((path, name, spooled, spooled.tell()))
+        size = sum(attachment[3] for attachment in attachments)
+
+        if size > SES_MAX_ATTACHMENTS and bucket:
+            log(f"INFO: the reports are {size / 2 ** 20:.1f} MB compressed, too big for SES - sending links")
+            region = _bucket_region(bucket, log)
+            links, attachments_to_send, missing, room = [], [], [], SES_MAX_ATTACHMENTS
+            for path, name, spooled, file_size in attachments:
+                spooled.seek(0)  # uploaded as it was compressed for the attachment
+                if _transfer(_Borrowed(spooled), bucket, name, log, path, region):
+                    links.append(clients.get('s3', region).generate_presigned_url(
+                        'get_object', Params={'Bucket': bucket, 'Key': name}, ExpiresIn=PRESIGN_SECONDS))
+                elif file_size <= room:
+                    attachments_to_send.append((name, spooled))
+                    room -= file_size
+                else:
+                    log(f"ERROR: {path} could not be uploaded and is too big to attach, it is not sent")
+                    missing.append(name)
+            if not links and not attachments_to_send:
+                log(f"ERROR: no report could be uploaded to s3://{bucket} or attached, email to {recipient} not sent")
+                return False
+            if links:
+                body += '\n\nThe reports are too big to attach, download links (valid 7 days):\n' + '\n'.join(links)
+            if missing:
+                body += '\n\nThese reports could not be sent: ' + ', '.join(missing)
+        else:
+            if size > SES_MAX_ATTACHMENTS:
+                log(f"WARNING: the reports are {size / 2 ** 20:.1f} MB compressed, SES may refuse them, "
+                    f"use --bucket_name to send links instead")
+            attachments_to_send = [(name, spooled) for _, name, spooled, _ in attachments]
+
+        msg = MIMEMultipart('mixed')
+        msg['Subject'] = subject
+        msg['From'] = sender
+        msg['To'] = recipient
+        msg_body = MIMEMultipart('alternative')
+        msg_body.attach(MIMEText(body.encode('utf-8'), 'plain', 'utf-8'))
+        msg.attach(msg_body)
+        for name, spooled in attachments_to_send:
+            spooled.seek(0)
+            attachment = MIMEApplication(spooled.read())
+            attachment.add_header('Content-Disposition', 'attachment', filename=name)
+            msg.attach(attachment)
+    finally:
+        for _, _, spooled, _ in attachments:
+            spooled.close()
+
+    try:
+        clients.get('ses', ses_region).send_raw_email(Source=sender, Destinations=[recipient],
+                                                      RawMessage={'Data': msg.as_bytes()})
+    except ClientError as e:
+        log(f"ERROR: email to {recipient} failed: {e}")
+        return False
+    log(f"INFO: {len(paths)} reports emailed to {recipient}")
+    return True
+
+
+def share_reports(paths, share, log, bucket=None, sender=None, recipient=None, subject='Report',
+                  body='Attached report', ses_region=SES_REGION):
+    """
+    deliver the reports of a run as requested with --share, see upload_s3 and send_email
+    :param paths: report/log files, the ones that don't exist (e.g. no log file) are skipped
+    :param share: 's3', 'email' or None
+    :return: None
+    """
+    paths = [path for path in paths if path and os.path.exists(path)]
+    if not paths or not share:
+        return
+    if share == 's3':
+        for path in paths:
+            upload_s3(path, bucket, log)
+    elif share == 'email':
+        send_email(sender, recipient, subject, body, paths, log, bucket, ses_region)
+    else:
+        log(f"ERROR: unknown --share {share}, use s3 or email")
@@ -0,0 +1,83 @@
+import json
+import os
+from threading import Lock
+from time import perf_counter
+
+SYNC_RECORDS = 1000  # records buffered before they are written and synced to disk
+SYNC_SECONDS = 2  # max seconds a record stays in the buffer (checked on the next record)
+
+
+class RunJournal:
+    """
+    append only json lines file of a run, one record per event (e.g. action planned / done).
+    records are buffered and written with one fsync per batch, so journaling does not slow the
+    run and a killed run only loses the last batch
+    """
+
+    def __init__(self, file_name, sync_records=SYNC_RECORDS, sync_seconds=SYNC_SECONDS):
+        """
+        :param file_name: journal file, records are appended if it exists
+        :param sync_records: max records in the buffer
+        :param sync_seconds: max age of the buffer
+        """
+        self.file_name = file_name
+        self.sync_records = sync_records
+        self.sync_seconds = sync_seconds
+        self.closed = False
+        self._file = open(file_name, 'a')
+        self._buffer = []
+        self._last_sync = perf_counter()
+        self._lock = Lock()  # records come from the worker threads
+
+    def write(self, event, **fields):
+        """
+        add a record to the journal
+        :param event: record type, e.g. 'done'
+        :param fields: json serializable fields of the record (str() is used for the others)
+        """
+        line = json.dumps(dict(event=event, **fields), default=str)
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.sync_records or perf_counter() - self._last_sync >= self.sync_seconds:
+                self._sync()
+
+    def sync(self):
+        """
+        write the buffered records and fsync them now, e.g. after a record a resumed run depends on
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._buffer:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._buffer.clear()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = perf_counter()
+
+    def close(self):
+        """
+        write the buffered records and close the file, only the first call does anything
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._sync()
+            self._file.close()
+
+
+def read_journal(file_name):
+    """
+    :param file_name: journal file of a previous run
+    :return: list of the records, a last line cut by a crash is ignored
+    """
+    records = []
+    with open(file_name) as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    return records
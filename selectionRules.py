@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+
+# EC2 filter name of the state of each resource type, the keys are the awsInventory types
+STATE_FILTERS = {'instances': 'instance-state-name', 'volumes': 'status', 'snapshots': 'status', 'images': 'state'}
+# awsInventory record field with the creation time of each resource type
+CREATED_FIELDS = {'instances': 'launch_time', 'volumes': 'create_time', 'snapshots': 'start_time',
+                  'images': 'creation_date'}
+
+
+class Rule:
+    """
+    selection of the resources of one type by state and age.
+    filters() is the part EC2 can select itself, sent as Filters with the describe_* call so the
+    other resources are not transferred at all. matches() checks the age on the records, EC2 has
+    no filter for it
+    """
+
+    def __init__(self, kind, states=(), older_than=None):
+        """
+        :param kind: resource type, one of STATE_FILTERS e.g. 'volumes'
+        :param states: states to select, e.g. ('available',), empty for all
+        :param older_than: days, select resources created more than this ago, None for all
+        """
+        if older_than is not None and kind not in CREATED_FIELDS:
+            raise ValueError(f"{kind} have no creation time")
+        self.kind = kind
+        self.states = tuple(states)
+        self.older_than = older_than
+
+    def __repr__(self):
+        return f"Rule({self.kind}, filters={self.filters()}, older_than={self.older_than})"
+
+    def filters(self):
+        """
+        :return: EC2 Filters list of the rule, empty when everything is selected
+        """
+        filters = []
+        if self.states:
+            filters.append({'Name': STATE_FILTERS[self.kind], 'Values': list(self.states)})
+        return filters
+
+    def matches(self, record):
+        """
+        check the part of the rule that filters() can't express
+        :param record: awsInventory record of the rule type
+        :return: True if the record is selected
+        """
+        if self.older_than is not None:
+            created = getattr(record, CREATED_FIELDS[self.kind])
+            if isinstance(created, str):  # images CreationDate, e.g. 2020-01-31T10:00:00.000Z
+                created = datetime.fromisoformat(created.replace('Z', '+00:00'))
+            if created and created > datetime.now(timezone.utc) - timedelta(days=self.older_than):
+                return False
+        return True
@@ -0,0 +1,166 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from ipaddress import ip_network
+
+ALL_PORTS = (0, 65535)
+PROTOCOL_NAMES = {'6': 'tcp', '17': 'udp', '1': 'icmp', '58': 'icmpv6'}  # AWS returns some protocols by number
+PORT_PROTOCOLS = ('tcp', 'udp')  # protocols with ports, the others are only returned by queries naming them
+
+
+class IntervalTree:
+    """
+    static centered interval tree of (start, end, item), built once and then queried for the items
+    overlapping a range in O(log n + matches)
+    """
+
+    def __init__(self, intervals):
+        """
+        :param intervals: list of (start, end, item), end included
+        """
+        for start, end, _ in intervals:
+            if start > end:
+                raise ValueError(f"interval ({start}, {end}) ends before it starts")
+        self.size = len(intervals)
+        self._root = self._build(intervals)
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+        points = sorted(point for start, end, _ in intervals for point in (start, end))
+        center = points[len(points) // 2]
+        left = [interval for interval in intervals if interval[1] < center]
+        right = [interval for interval in intervals if interval[0] > center]
+        middle = [interval for interval in intervals if interval[0] <= center <= interval[1]]
+        by_start = sorted(middle, key=lambda interval: interval[0])
+        by_end = sorted(middle, key=lambda interval: interval[1])
+        # node: center, intervals containing it sorted by start and by end (with the sort keys), children
+        return (center, by_start, [interval[0] for interval in by_start], by_end, [interval[1] for interval in by_end],
+                self._build(left), self._build(right))
+
+    def overlapping(self, low, high):
+        """
+        :return: items of the intervals overlapping [low, high]
+        """
+        items = []
+        stack = [self._root] if self._root else []
+        while stack:
+            center, by_start, starts, by_end, ends, left, right = stack.pop()
+            if high < center:  # only the node intervals starting before high overlap
+                items += [interval[2] for interval in by_start[:bisect_right(starts, high)]]
+            elif low > center:  # only the node intervals ending after low overlap
+                items += [interval[2] for interval in by_end[bisect_left(ends, low):]]
+            else:  # all of them contain center, which is in the range
+                items += [interval[2] for interval in by_start]
+            if left and low < center:
+                stack.append(left)
+            if right and high > center:
+                stack.append(right)
+        return items
+
+
+def parse_port(text):
+    """
+    :param text: 'PORT[/proto]' or 'FROM-TO[/proto]', e.g. '22', '3389/tcp', '1000-2000/udp', '8/icmp' (the
+                 ICMP type for icmp)
+    :return: (from port, to port, protocol or None for the protocols with ports)
+    :raise ValueError: the ports are not numbers from 0 to 65535, or the range ends before it starts
+    """
+    ports, _, protocol = text.partition('/')
+    low, _, high = ports.partition('-')
+    low, high = int(low), int(high or low)
+    if not ALL_PORTS[0] <= low <= high <= ALL_PORTS[1]:
+        raise ValueError(f"bad port range {ports}")
+    protocol = PROTOCOL_NAMES.get(protocol, protocol).lower()
+    return low, high, None if protocol in ('', '-1', 'all') else protocol
+
+
+class SgIndex:
+    """
+    in-memory index of the flattened inbound rules of the sgReport rows, to answer "which security
+    groups allow PORT[/proto] from CIDR" without reading the report:
+    - sources: the CIDRs are keyed by (version, network, prefix length), the rules of the CIDRs
+      containing a query CIDR are found with one dict lookup per prefix length of the query.
+      prefix lists and security group sources can't be compared to a CIDR, they are only
+      returned by queries without a CIDR
+    - protocols: one port interval tree per source and protocol, 'All' protocol rules are kept
+      under 'all' and returned for any protocol. a query without protocol is a tcp/udp query, the
+      other protocols (icmp...) have no ports and are only returned when the query names them
+    - ports: IntervalTree of the rule port ranges, 'All' ports are the full range. icmp rules have
+      the ICMP type in FromPort (and the code in ToPort), they are indexed by type, all types for 'N/A'
+    - any source: the queries without CIDR use one tree per protocol of the rules of all the sources
+    """
+
+    def __init__(self):
+        self.rules = 0
+        self._intervals = defaultdict(list)  # (source key, protocol) and protocol -> (from port, to port, row)
+        self._trees = {}  # (source key, protocol) -> IntervalTree of the intervals, protocol -> all the sources
+        self._changed = set()  # keys with rules added since their tree was built
+        self._protocols = defaultdict(set)  # source key -> protocols of its rules
+        self._prefix_lengths = {4: set(), 6: set()}  # prefix lengths of the indexed CIDRs
+
+    def add(self, row):
+        """
+        index the rule of a report row, rows of groups without inbound rules are ignored
+        :param row: sgReport row, with IpProtocol, FromPort, ToPort and Source
+        """
+        if row['IpProtocol'] == 'N/A' and row['Source'] == 'N/A':
+            return
+        protocol = 'all' if row['IpProtocol'] == 'All' else PROTOCOL_NAMES.get(str(row['IpProtocol']),
+                                                                              str(row['IpProtocol']).lower())
+        if not isinstance(row['FromPort'], int) or row['FromPort'] < 0:  # All, or N/A (e.g. all ICMP types)
+            ports = ALL_PORTS
+        elif protocol in PORT_PROTOCOLS:
+            ports = (row['FromPort'], row['ToPort'])
+        else:  # icmp type (ToPort is its code), or a protocol number without ports
+            ports = (row['FromPort'], row['FromPort'])
+        try:
+            network = ip_network(row['Source'], strict=False)
+            source = (network.version, int(network.network_address), network.prefixlen)
+            self._prefix_lengths[network.version].add(network.prefixlen)
+        except ValueError:  # prefix list or security group
+            source = row['Source']
+        for key in ((source, protocol), protocol):
+            self._intervals[key].append((ports[0], ports[1], row))
+            self._changed.add(key)
+        self._protocols[source].add(protocol)
+        self.rules += 1
+
+    def freeze(self):
+        """
+        build the interval trees of the rules added since the last call, query() calls it when needed
+        """
+        for key in self._changed:
+            self._trees[key] = IntervalTree(self._intervals[key])
+        self._changed.clear()
+
+    def _sources(self, cidr):
+        """
+        :param cidr: query CIDR
+        :return: source keys allowing the whole CIDR, one per prefix length of the index (a CIDR containing
+                 the query CIDR has the query network address cut to its prefix length)
+        """
+        network = ip_network(cidr, strict=False)
+        address = int(network.network_address)
+        bits = network.max_prefixlen
+        return [(network.version, address >> (bits - length) << (bits - length), length)
+                for length in self._prefix_lengths[network.version] if length <= network.prefixlen]
+
+    def query(self, low, high=None, protocol=None, cidr=None):
+        """
+        :param low: first port of the query range (ICMP type for icmp)
+        :param high: last port of the query range, low when None
+        :param protocol: tcp, udp, icmp... None for tcp and udp
+        :param cidr: the rules must allow this whole CIDR (e.g. 0.0.0.0/0), None for any source
+        :return: report rows of the rules allowing a port of the range
+        """
+        if self._changed:
+            self.freeze()
+        high = low if high is None else high
+        protocols = {'all', *PORT_PROTOCOLS} if protocol is None else {'all', PROTOCOL_NAMES.get(protocol, protocol)}
+        if cidr is None:
+            return [row for key in protocols if key in self._trees for row in self._trees[key].overlapping(low, high)]
+        rows = []
+        for source in self._sources(cidr):
+            for key_protocol in self._protocols.get(source, set()) & protocols:
+                rows += self._trees[source, key_protocol].overlapping(low, high)
+        return rows
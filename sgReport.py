@@ -1,7 +1,17 @@
 from csv import DictWriter
-import boto3
-from time import strftime
+import gzip
+import hashlib
+import json
+import sqlite3
+import sys
+from time import strftime, perf_counter
+import argparse
 import configparser
+from awsCommon import get_sg_attachments, paginate, setup_logging, close_logging, log_line, clients, LOG_LEVELS
+from apiMetrics import metrics, instrument, start_profile, report_metrics
+from sgIndex import SgIndex, parse_port
+from reportDelivery import share_reports, SES_REGION
+from inventoryStore import InventoryStore
 
 
 def get_config_regions():
@@ -31,33 +41,121 @@ def get_config_regions():
         return region_list
 
 
-def _create_csv_file(file_prefix, headers):
+class SgCache:
     """
-    Create CSV file with headers to be used later to report the results
-    :param file_prefix: prefix for the file name
-    :param headers: headers for the csv
-    :return: file name (prefix+date_time)
+    sqlite file with the fingerprint (hash of the rules, tags and attachments) and the report rows of
+    each security group of the last scan. unchanged groups are not processed again, their rows come
+    from the cache, and the rows of the changed groups give the delta against the last scan
     """
-    file_name = strftime(file_prefix + "%Y-%b-%d_%H-%M-%S.csv")
-    _log('INFO: Creating CSV File and Headers')
-    with open(file_name, "w") as file:
-        csv_writer = DictWriter(file, fieldnames=headers, lineterminator='\n')
-        csv_writer.writeheader()
-    return file_name
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._db = sqlite3.connect(file_name)
+        self._db.execute('CREATE TABLE IF NOT EXISTS sg (group_id TEXT PRIMARY KEY, region TEXT, fingerprint TEXT, '
+                         'rows TEXT, scanned_at TEXT)')
+
+    def load(self, region):
+        """
+        :param region: region name
+        :return: dict of group id -> (fingerprint, list of report rows) of the last scan of the region
+        """
+        return {group_id: (fingerprint, json.loads(rows)) for group_id, fingerprint, rows in
+                self._db.execute('SELECT group_id, fingerprint, rows FROM sg WHERE region = ?', (region,))}
+
+    def put(self, group_id, region, fingerprint, rows):
+        self._db.execute('INSERT OR REPLACE INTO sg VALUES (?, ?, ?, ?, ?)',
+                         (group_id, region, fingerprint, json.dumps(rows, default=str),
+                          strftime('%Y-%m-%dT%H:%M:%S')))
+
+    def evict(self, group_ids):
+        """
+        :param group_ids: groups that no longer exist
+        """
+        self._db.executemany('DELETE FROM sg WHERE group_id = ?', [(group_id,) for group_id in group_ids])
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+def sg_fingerprint(sg, instances):
+    """
+    :param sg: security group from describe_security_groups
+    :param instances: instance/eni ids using the group
+    :return: hash of everything the report shows of the group
+    """
+    content = [sg['GroupName'], sg.get('VpcId'), sg.get('OwnerId'), sg['IpPermissions'],
+               sorted((tag['Key'], tag['Value']) for tag in sg.get('Tags', [])), instances]
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
 
 
-def add_sg_record_csv(file_name, headers, security_group_record):
+def sg_delta(group_id, old_rows, new_rows):
+    """
+    compare the report rows of a group between the last scan and this one
+    :param old_rows: rows of the last scan, None if the group is new
+    :param new_rows: rows of this scan, None if the group was removed
+    :return: list of delta report rows
+    """
+    def rule(row):
+        return row['IpProtocol'], row['FromPort'], row['ToPort'], row['Source']
+
+    if old_rows is None:
+        return [dict(row, Change='added SG') for row in new_rows]
+    if new_rows is None:
+        return [dict(row, Change='removed SG') for row in old_rows]
+
+    old_rules = {rule(row) for row in old_rows}
+    new_rules = {rule(row) for row in new_rows}
+    delta = [dict(row, Change='added rule') for row in new_rows if rule(row) not in old_rules]
+    delta += [dict(row, Change='removed rule') for row in old_rows if rule(row) not in new_rules]
+    changed = [header for header in ('SG Name', 'VpcId', 'OwnerId', 'Instances', 'Tags')
+               if str(old_rows[0][header]) != str(new_rows[0][header])]
+    if changed:
+        delta.append(dict(new_rows[0], Change='modified', FromPort=None, ToPort=None, IpProtocol=None, Source=None,
+                          Detail=', '.join(f"{header}: {old_rows[0][header]} -> {new_rows[0][header]}"
+                                           for header in changed)))
+    return delta
+
+
+class SgReportWriter:
     """
-    add security group record to existing csv file
-    :param file_name: existing csv report, created in _create_csv_file
-    :param headers: headers for the existing csv file, used to write data row
-    :param security_group_record: sg dictionary to be added to csv
+    report file that stays open for the whole scan, rows are kept in memory and written
+    in batches of batch_size. csv (default) and jsonl can be gzip compressed, parquet needs pyarrow
     """
 
-    with open(file_name, "a") as file:
-        csv_writer = DictWriter(file, fieldnames=headers, lineterminator='\n')
-        _log(f'INFO: Adding following record to CSV - {security_group_record}')
-        csv_writer.writerow({
+    def __init__(self, file_prefix, headers, report_format='csv', compress=False, batch_size=1000):
+        self.headers = headers
+        self.report_format = report_format
+        self.batch_size = batch_size
+        self._batch = []
+        self.file_name = strftime(file_prefix + "%Y-%b-%d_%H-%M-%S." + report_format)
+        _log(f'INFO: Creating {report_format} report - {self.file_name}')
+
+        if report_format == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            self._pyarrow = pyarrow
+            schema = pyarrow.schema([(header, pyarrow.string()) for header in headers])
+            self._file = pyarrow.parquet.ParquetWriter(self.file_name, schema,
+                                                       compression='gzip' if compress else 'snappy')
+            return
+
+        if compress:
+            self.file_name += '.gz'
+            self._file = gzip.open(self.file_name, "wt")
+        else:
+            self._file = open(self.file_name, "w")
+        if report_format == 'csv':
+            self._csv_writer = DictWriter(self._file, fieldnames=headers, lineterminator='\n')
+            self._csv_writer.writeheader()
+
+    @staticmethod
+    def report_row(security_group_record):
+        """
+        :param security_group_record: sg dictionary built by the scan
+        :return: report row of the record, a new dict keyed by the report headers
+        """
+        return {
             "Region": security_group_record['Region'],
             "OwnerId": security_group_record['OwnerId'],
             "SG Name": security_group_record['GroupName'],
@@ -70,126 +168,381 @@ def add_sg_record_csv(file_name, headers, security_group_record):
             "Instances": security_group_record['Instances'],
             "Tags": security_group_record['Tags'],
 
-        })
-
-def scan_sg():
+        }
+
+    def add_row(self, row):
+        """
+        add a row to the report
+        :param row: dict keyed by the report headers
+        """
+        _log('DEBUG: Adding following record to report - %s', row)
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        write the rows kept in memory to the report file
+        """
+        if not self._batch:
+            return
+        if self.report_format == 'csv':
+            self._csv_writer.writerows(self._batch)
+        elif self.report_format == 'jsonl':
+            self._file.writelines(json.dumps(row, default=str) + '\n' for row in self._batch)
+        else:
+            columns = {header: [None if row.get(header) is None else str(row[header]) for row in self._batch]
+                       for header in self.headers}
+            self._file.write_table(self._pyarrow.table(columns))
+        self._batch = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+DELTA_HEADERS = ["Region", "OwnerId", "SG Name", "SG Id", "VpcId", "Change", "FromPort", "ToPort", "IpProtocol",
+                 "Source", "Instances", "Tags", "Detail"]
+
+
+def scan_sg(report_format='csv', compress=False):
     """
     main function, check each region for security groups with boto3
-    then it add them to csv report that contains all the ports, Ips and related instances
+    then it add them to csv report that contains all the ports, Ips and related instances.
+    with the cache, the groups that did not change since the last scan are taken from it and
+    the changes are written to a delta report
+    :param report_format: 'csv', 'jsonl' or 'parquet'
+    :param compress: gzip the report
+    :return: names of the report files
     """
     headers = ["Region", "OwnerId", "SG Name", "SG Id", "VpcId", "FromPort",
                "ToPort", "IpProtocol", "Source", "Instances", "Tags"]
-    csv_file = _create_csv_file("SG_report_", headers)
+    report = SgReportWriter("SG_report_", headers, report_format, compress)
+    delta = SgReportWriter("SG_delta_", DELTA_HEADERS, report_format, compress) if cache else None
+    try:
+        with metrics.phase('scan_sg'):
+            _scan_sg_regions(report, delta)
+    finally:
+        report.close()
+        if delta:
+            delta.close()
+    _log(f'INFO: Report saved - {report.file_name}')
+    if delta:
+        _log(f'INFO: Delta report saved - {delta.file_name}')
+    return [report.file_name] + ([delta.file_name] if delta else [])
+
+
+def _scan_sg_regions(report, delta):
+    """
+    add the security groups of each region to the report
+    :param report: SgReportWriter
+    :param delta: SgReportWriter of the changes since the last scan, None without the cache
+    """
 
     for region in regions:  # iterate over the region list and get the SG's
-        ec2 = boto3.client('ec2', region_name=region.strip())
-        response = ec2.describe_security_groups()
-
         _log(f"INFO: currently in region - {region}")
+        sg_attachments, groups = _region_groups(region.strip())
+        previous = cache.load(region) if cache else {}  # group id -> (fingerprint, rows) of the last scan
+        if cache and not previous:
+            _log(f"INFO: {region} was not scanned before, no delta for it")
+        seen = set()
+        unchanged = 0
+
+        for sg in groups:  # iterate over all the SG in the current region
+            group_id = sg['GroupId']
+            seen.add(group_id)
+            instances = sg_attachments.get(group_id, [])
+            fingerprint = sg_fingerprint(sg, instances) if cache else None
+            cached = previous.get(group_id)
+            if cached and cached[0] == fingerprint:
+                rows = cached[1]
+                unchanged += 1
+            else:
+                _log(f"INFO: Found security group: {group_id}")
+                _log('DEBUG: %s', sg)
+                rows = _sg_rows(region, sg, instances)
+                if cache:
+                    cache.put(group_id, region, fingerprint, rows)
+                if previous:
+                    for row in sg_delta(group_id, cached[1] if cached else None, rows):
+                        delta.add_row(row)
+            for row in rows:
+                report.add_row(row)
+                if index:
+                    index.add(row)
+
+        removed = [group_id for group_id in previous if group_id not in seen]
+        for group_id in removed:
+            for row in sg_delta(group_id, previous[group_id][1], None):
+                delta.add_row(row)
+        if cache:
+            cache.evict(removed)
+            _log(f"INFO: {region}: {unchanged} unchanged security groups from cache, {len(seen) - unchanged} "
+                 f"scanned, {len(removed)} removed")
+        _log("INFO: Region END")
 
-        security_group_record = {'Region': region}  # dict for the SG, will be send later to the CSV
 
-        for sg in response['SecurityGroups']:  # iterate over all the SG in the current region and add data to dict
-            _log(f"INFO: Found security group: {sg}")
+def _region_groups(region):
+    """
+    security groups of a region and their attachments, from the store with --from_cache unless they
+    are missing or stale in it (see inventoryStore.STORE_TTL), otherwise fetched from EC2 and saved to the store
+    :param region: region name
+    :return: (dict of sg id -> instance/eni ids using it, list of describe_security_groups items)
+    """
+    refreshed = []
+    stored = store.load(region, 'report_sg_attachments') if from_cache else None
+    if stored is None:
+        sg_attachments = get_sg_attachments(clients.get('ec2', region))
+        store.save(region, 'report_sg_attachments', [(group_id, {'id': group_id, 'used_by': used_by})
+                                                     for group_id, used_by in sg_attachments.items()])
+        refreshed.append('attachments')
+    else:
+        sg_attachments = {fields['id']: fields['used_by'] for fields in stored}
 
-            security_group_record['GroupName'] = sg['GroupName']
-            security_group_record['VpcId'] = sg.get('VpcId')
-            security_group_record['OwnerId'] = sg.get('OwnerId')
+    groups = store.load(region, 'report_security_groups') if from_cache else None
+    if groups is None:
+        groups = list(paginate(clients.get('ec2', region), 'describe_security_groups', 'SecurityGroups'))
+        store.save(region, 'report_security_groups', [(sg['GroupId'], sg) for sg in groups])
+        refreshed.append('security groups')
+    if from_cache:
+        _log(f"INFO: {region}: fetched from AWS (missing or stale in {store.file_name}) - {refreshed or 'none'}")
+    return sg_attachments, groups
 
-            security_group_record['Instances'] = ''
 
-            # get instances so we have SG -> relation
-            _log('INFO: Checking EC2 Relation')
-            instances_for_sg = ec2.describe_instances(
-                Filters=[{'Name': 'instance.group-id', 'Values': [sg.get('GroupId'), ]}, ])
-            instances_for_sg = [i for instance in instances_for_sg['Reservations'] for i in
-                                instance['Instances']]
-            instances_for_sg = [instance['InstanceId'] for instance in instances_for_sg]
+def _sg_rows(region, sg, instances):
+    """
+    flatten the inbound rules of a security group, one row per rule source
+    :param region: region of the group
+    :param sg: security group from describe_security_groups
+    :param instances: instance/eni ids using the group, so we have SG -> relation
+    :return: list of report rows
+    """
+    rows = []
+    security_group_record = {'Region': region}  # dict for the SG, will be send later to the CSV
+    security_group_record['GroupName'] = sg['GroupName']
+    security_group_record['VpcId'] = sg.get('VpcId')
+    security_group_record['OwnerId'] = sg.get('OwnerId')
 
-            # remove 'key'/'value' , so tags look nice in csv
-            if not sg.get('Tags'):
-                tags_for_format = 'N/A'
-            else:
-                tags_for_format = {tag.get('Key'): tag.get('Value') for tag in sg.get('Tags')}
-            security_group_record['Tags'] = tags_for_format
+    security_group_record['Instances'] = ''
 
+    # remove 'key'/'value' , so tags look nice in csv
+    if not sg.get('Tags'):
+        tags_for_format = 'N/A'
+    else:
+        tags_for_format = {tag.get('Key'): tag.get('Value') for tag in sg.get('Tags')}
+    security_group_record['Tags'] = tags_for_format
+
+
+    if not instances:
+        _log('INFO: no instances, setting to N/A')
+        security_group_record['Instances'] = 'N/A'
+
+    else:
+        _log(f'INFO: Related instances - {instances}')
+        security_group_record['Instances'] = ', '.join(instances)  # convert instance list to string
 
-            if not instances_for_sg:
-                _log('INFO: no instances, setting to N/A')
-                security_group_record['Instances'] = 'N/A'
 
-            else:
-                _log(f'INFO: Related instances - {instances_for_sg}')
-                security_group_record['Instances'] = ', '.join(instances_for_sg)  # convert instance list to string
 
+    security_group_record['GroupId'] = sg.get('GroupId')
 
+    if not sg['IpPermissions']:  # for sg with no inbound roles
+        _log('SG has no inbound roles, setting to N/A')
+        security_group_record['FromPort'] = 'N/A'
+        security_group_record['ToPort'] = 'N/A'
+        security_group_record['IpProtocol'] = 'N/A'
+        security_group_record['Source'] = 'N/A'
+        rows.append(SgReportWriter.report_row(security_group_record))
 
-            security_group_record['GroupId'] = sg.get('GroupId')
 
-            if not sg['IpPermissions']:  # for sg with no inbound roles
-                _log('SG has no inbound roles, setting to N/A')
+    for element in sg['IpPermissions']:
+
+        if element['IpProtocol'] != '-1':
+
+            if element['FromPort'] != -1:
+                security_group_record['FromPort'] = element.get('FromPort')
+                security_group_record['ToPort'] = element.get('ToPort')
+                security_group_record['IpProtocol'] = element.get('IpProtocol')
+            else:
+                _log('SG has no port, setting to N/A')
                 security_group_record['FromPort'] = 'N/A'
                 security_group_record['ToPort'] = 'N/A'
-                security_group_record['IpProtocol'] = 'N/A'
-                security_group_record['Source'] = 'N/A'
-                add_sg_record_csv(csv_file, headers, security_group_record)
-
-
-            for element in sg['IpPermissions']:
-
-                if element['IpProtocol'] != '-1':
-
-                    if element['FromPort'] != -1:
-                        security_group_record['FromPort'] = element.get('FromPort')
-                        security_group_record['ToPort'] = element.get('ToPort')
-                        security_group_record['IpProtocol'] = element.get('IpProtocol')
-                    else:
-                        _log('SG has no port, setting to N/A')
-                        security_group_record['FromPort'] = 'N/A'
-                        security_group_record['ToPort'] = 'N/A'
-                        security_group_record['IpProtocol'] = element.get('IpProtocol')
-
-                else:  # for '-1' in IpPermissions, print 'All' to csv
-                    security_group_record['FromPort'] = 'All'
-                    security_group_record['ToPort'] = 'All'
-                    security_group_record['IpProtocol'] = 'All'
-                #todo - ,
-                for group in element['PrefixListIds']:  # if source is another SG , save and add to CSV
-                    security_group_record['Source'] = group['PrefixListId']
-                    add_sg_record_csv(csv_file, headers, security_group_record)
-
-                for group in element['Ipv6Ranges']:  # if source is another SG , save and add to CSV
-                    security_group_record['Source'] = group['CidrIpv6']
-                    add_sg_record_csv(csv_file, headers, security_group_record)
-
-                for group in element['UserIdGroupPairs']:  # if source is another SG , save and add to CSV
-                    security_group_record['Source'] = group['GroupId']
-                    add_sg_record_csv(csv_file, headers, security_group_record)
-
-                for cidr in element['IpRanges']:  # if source a cidr ranger, loop/save/add to csv
-                    security_group_record['Source'] = cidr.get('CidrIp')
-                    add_sg_record_csv(csv_file, headers, security_group_record)
+                security_group_record['IpProtocol'] = element.get('IpProtocol')
 
-        _log("INFO: Region END")
+        else:  # for '-1' in IpPermissions, print 'All' to csv
+            security_group_record['FromPort'] = 'All'
+            security_group_record['ToPort'] = 'All'
+            security_group_record['IpProtocol'] = 'All'
+        #todo - ,
+        for group in element['PrefixListIds']:  # if source is another SG , save and add to CSV
+            security_group_record['Source'] = group['PrefixListId']
+            rows.append(SgReportWriter.report_row(security_group_record))
 
+        for group in element['Ipv6Ranges']:  # if source is another SG , save and add to CSV
+            security_group_record['Source'] = group['CidrIpv6']
+            rows.append(SgReportWriter.report_row(security_group_record))
 
-def _log(line):
+        for group in element['UserIdGroupPairs']:  # if source is another SG , save and add to CSV
+            security_group_record['Source'] = group['GroupId']
+            rows.append(SgReportWriter.report_row(security_group_record))
+
+        for cidr in element['IpRanges']:  # if source a cidr ranger, loop/save/add to csv
+            security_group_record['Source'] = cidr.get('CidrIp')
+            rows.append(SgReportWriter.report_row(security_group_record))
+    return rows
+
+
+def read_queries(exposes, from_cidr, queries_file):
+    """
+    :param exposes: --exposes values, 'PORT[/proto]'
+    :param from_cidr: --from CIDR of the --exposes queries, None for any source
+    :param queries_file: file with one 'PORT[/proto] [CIDR]' query per line, # for comments
+    :return: list of (query text, (from port, to port, protocol), CIDR), see sgIndex.parse_port
+    :raise ValueError: a port or CIDR is not valid, checked before the scan
     """
-    used instead of print, can log to console and/or log file
+    from ipaddress import ip_network
+    texts = [(port, from_cidr) for port in exposes or []]
+    if queries_file:
+        with open(queries_file) as file:
+            for line in file:
+                fields = line.split('#')[0].split()
+                if fields:
+                    texts.append((fields[0], fields[1] if len(fields) > 1 else None))
+    queries = []
+    for port, cidr in texts:
+        try:
+            ports = parse_port(port)
+            if cidr is not None:
+                ip_network(cidr, strict=False)
+        except ValueError as e:
+            raise ValueError(f"bad query {port}{' from ' + cidr if cidr else ''}: {e}")
+        queries.append((f"{port} from {cidr or 'any'}", ports, cidr))
+    return queries
+
+
+def run_queries(queries, report_format='csv', compress=False):
+    """
+    answer the exposure queries from the index built by the scan, the matching rules of each query
+    are written to a report and the number of matching security groups is printed
+    :param queries: read_queries result
+    :return: name of the report file
+    """
+    headers = ["Query", "Region", "OwnerId", "SG Name", "SG Id", "VpcId", "FromPort", "ToPort", "IpProtocol",
+               "Source", "Instances", "Tags"]
+    report = SgReportWriter("SG_exposure_", headers, report_format, compress)
+    try:
+        for text, (low, high, protocol), cidr in queries:
+            start = perf_counter()
+            rows = index.query(low, high, protocol, cidr)
+            duration = perf_counter() - start
+            groups = {row['SG Id'] for row in rows}
+            print(f"{text}: {len(groups)} security groups, {len(rows)} rules ({duration * 1000:.3f} ms)")
+            _log(f"INFO: query {text}: {len(groups)} security groups, {len(rows)} rules ({duration * 1000:.3f} ms)")
+            for row in rows:
+                report.add_row(dict(row, Query=text))
+    finally:
+        report.close()
+    print(f"Exposure report saved - {report.file_name}")
+    return report.file_name
+
+
+logger = setup_logging('sgReport', console=False)
+
+
+def _log(line, *args):
+    """
+    used instead of print, can log to console and/or log file, see awsCommon.log_line
     :param line: line to be printed to log
+    :param args: objects formatted into line with %s only if the level is logged
     """
-
-    console = False
-    log = False
-    if log:
-        with open(log_name, "a") as file:
-            file.write(str(line) + '\n')
-    if console:
-        print(line)
+    log_line(logger, line, *args)
 
 
 if __name__ == '__main__':
-    log_name = strftime('sg_log_' + "%Y-%b-%d_%H-%M-%S.log")
+    parser = argparse.ArgumentParser(description='Create CSV report of the security groups in the config.txt regions')
+    parser.add_argument('--format', '-f', type=str, choices=('csv', 'jsonl', 'parquet'), default='csv',
+                        help='report format, parquet needs pyarrow (default csv)')
+    parser.add_argument('--compress', metavar='Bool', type=str,
+                        help='gzip the report')
+    parser.add_argument('--cache', metavar='Bool', type=str, default='True',
+                        help='keep a fingerprint and the rows of each security group in --cache_file, unchanged groups '
+                             'are not processed again and the changes since the last run go to a delta report '
+                             '(default True)')
+    parser.add_argument('--cache_file', type=str, default='SgCache.db',
+                        help='sqlite file of the security groups cache')
+    parser.add_argument('--inventory_file', type=str, default='Inventory.db',
+                        help='sqlite store the scanned security groups are saved to, for --from_cache '
+                             '(default Inventory.db)')
+    parser.add_argument('--from_cache', metavar='Bool', type=str,
+                        help='report from the --inventory_file store without scanning, only the regions missing in '
+                             'it or stale are fetched again')
+    parser.add_argument('--exposes', type=str, action='append', metavar='PORT[/proto]',
+                        help='after the scan, list the security groups allowing this port or port range (22, '
+                             '3389/tcp, 1000-2000/udp, tcp and udp without /proto, 8/icmp for an ICMP type), can be '
+                             'repeated')
+    parser.add_argument('--from', dest='from_cidr', type=str, metavar='CIDR',
+                        help='with --exposes, only the rules allowing this whole CIDR, e.g. 0.0.0.0/0')
+    parser.add_argument('--exposes_file', type=str,
+                        help="file of --exposes queries, one 'PORT[/proto] [CIDR]' per line")
+    parser.add_argument('--share', '-sh', type=str, choices=('s3', 'email'),
+                        help='share the report and log file via s3 or email, gzip compressed')
+    parser.add_argument('--bucket_name', '-b', type=str,
+                        help='Bucket name to upload to, if --share=s3 selected, with --share=email the files too big '
+                             'to attach are uploaded to it and linked')
+    parser.add_argument('--ses_sender', '-sess', type=str,
+                        help='email SES details, if --share=email selected')
+    parser.add_argument('--ses_recipient', '-sesr', type=str,
+                        help='email SES details, if --share=email selected')
+    parser.add_argument('--ses_region', type=str, default=SES_REGION,
+                        help=f'SES region, if --share=email selected (default {SES_REGION})')
+    parser.add_argument('--log', metavar='Bool', type=str,
+                        help='Will create logs file for the CLI Operations')
+    parser.add_argument('--log_level', type=str, choices=LOG_LEVELS, default='INFO',
+                        help='DEBUG also logs the raw AWS responses (default INFO)')
+    parser.add_argument('--log_json', metavar='Bool', type=str,
+                        help='write the log file as json lines')
+    parser.add_argument('--metrics', metavar='Bool', type=str,
+                        help='write the AWS calls and phases metrics to a json file (the summary is always logged)')
+    parser.add_argument('--profile', metavar='Bool', type=str,
+                        help='run with cProfile and save the stats to a .prof file')
+    args = parser.parse_args()
+
+    log_name = strftime('sg_log_' + "%Y-%b-%d_%H-%M-%S" + ('.jsonl' if args.log_json == 'True' else '.log'))
+    logger = setup_logging('sgReport', log_name if args.log == 'True' else None, console=False,
+                           level=args.log_level, json_lines=args.log_json == 'True')
+    if args.share == 's3' and not args.bucket_name:
+        print('ERROR: --bucket_name is needed with --share s3')
+        sys.exit(1)
+    if args.share == 'email' and not (args.ses_sender and args.ses_recipient):
+        print('ERROR: --ses_sender and --ses_recipient are needed with --share email')
+        sys.exit(1)
+    try:
+        queries = read_queries(args.exposes, args.from_cidr, args.exposes_file)
+    except (ValueError, OSError) as e:  # before the scan, not after it
+        print(f'ERROR: {e}')
+        sys.exit(1)
+
+    instrument()
+    profilers = start_profile() if args.profile == 'True' else None
     regions = get_config_regions()
-    xlsx_name = strftime('sgReport_' + "%Y-%b-%d_%H-%M-%S.xlsx")
-    scan_sg()
+    cache = SgCache(args.cache_file) if args.cache == 'True' else None
+    store = InventoryStore(args.inventory_file)
+    from_cache = args.from_cache == 'True'
+    index = SgIndex() if queries else None
+    report_files = []
+    try:
+        report_files = scan_sg(args.format, args.compress == 'True')
+        if queries:
+            report_files.append(run_queries(queries, args.format, args.compress == 'True'))
+    finally:
+        if cache:
+            cache.close()
+        store.close()
+        report_metrics(_log, strftime('sg_metrics_%Y-%b-%d_%H-%M-%S.json') if args.metrics == 'True' else None,
+                       profilers, strftime('sg_profile_%Y-%b-%d_%H-%M-%S.prof'))
+
+    if args.share:
+        close_logging(logger)  # write the buffered log lines before the log is shared
+        logger = setup_logging('sgReport', level=args.log_level)  # the log file is closed, the sharing goes to console
+        share_reports(report_files + [log_name if args.log == 'True' else None], args.share, _log, args.bucket_name,
+                      args.ses_sender, args.ses_recipient, "Security groups report", "Attached security groups report",
+                      args.ses_region)